@@ -0,0 +1,255 @@
+#bedrock_client.py
+"""
+Shared Bedrock invocation layer.
+
+One BedrockInvoker per region is shared by every LLMParser in the process,
+so all batches and books draw from the same connection pool, concurrency
+limit and request rate. The rate adapts: it halves on throttling and creeps
+back up while calls succeed.
+"""
+import json
+import time
+import random
+import threading
+import logging
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, BotoCoreError
+
+logger = logging.getLogger(__name__)
+
+THROTTLING_ERRORS = ('ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException')
+# Transient errors worth another attempt
+RETRYABLE_ERRORS = THROTTLING_ERRORS + (
+    'ServiceUnavailableException', 'ModelNotReadyException', 'InternalServerException',
+    'ModelTimeoutException'
+)
+
+
+class BedrockInvocationError(RuntimeError):
+    """A Bedrock call that failed for good, after any retries"""
+
+
+class TokenBucket:
+    """
+    Request rate limiter with additive increase / multiplicative decrease:
+    throttled() halves the rate, succeeded() adds increase back, within
+    [min_rate, max_rate] requests per second. Throttles within a second of
+    the last decrease count once, as they usually come from the same burst.
+    """
+
+    def __init__(self, rate, min_rate=0.05, max_rate=None, increase=0.05):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate * 4
+        self.increase = increase
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.decreased = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        # A burst of at most one second's worth of requests
+        self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self._refill()
+            if self.updated - self.decreased >= 1.0:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.decreased = self.updated
+
+    def succeeded(self):
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+class InvocationResult:
+    """
+    Outcome of a Bedrock call; body is the decoded response when ok, and the
+    partial response for a stream that broke off.
+    """
+    __slots__ = ("ok", "body", "error", "attempts")
+
+    def __init__(self, ok, body=None, error=None, attempts=1):
+        self.ok = ok
+        self.body = body
+        self.error = error
+        self.attempts = attempts
+
+    def __repr__(self):
+        return f"InvocationResult(ok={self.ok}, error={self.error!r}, attempts={self.attempts})"
+
+
+class BedrockInvoker:
+    """Thread-safe invoke_model with rate limiting, a concurrency cap and jittered retries"""
+
+    def __init__(self, region_name='us-east-1', max_concurrency=8, requests_per_second=1.0,
+                 max_attempts=8, base_delay=2.0, max_delay=60.0, read_timeout=600):
+        """
+        Args:
+            max_concurrency: Calls in flight at once, across all callers
+            requests_per_second: Starting request rate; adapted to throttling
+            max_attempts: Attempts per call before giving up
+            base_delay, max_delay: Bounds of the exponential backoff (full jitter)
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bucket = TokenBucket(requests_per_second)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.throttles = 0
+        self.retries = 0
+        self.failures = 0
+        # Retries are done here, where they can slow the shared rate down
+        self.client = boto3.client(
+            'bedrock-runtime',
+            region_name=region_name,
+            config=Config(
+                read_timeout=read_timeout,
+                connect_timeout=60,
+                max_pool_connections=max_concurrency,
+                retries={'total_max_attempts': 1}
+            )
+        )
+
+    def invoke(self, model_id, body):
+        """Call the model with a JSON request body; never raises for service errors"""
+        def call():
+            response = self.client.invoke_model(
+                modelId=model_id,
+                body=json.dumps(body),
+                contentType='application/json',
+                accept='application/json'
+            )
+            return json.loads(response['body'].read())
+        return self._run(call)
+
+    def invoke_stream(self, model_id, body, on_text):
+        """
+        Like invoke, but streams the response, passing each piece of text to
+        on_text as it arrives. The result body has the same shape as invoke's.
+        Once text has been passed on a failure is not retried; the result is
+        then not ok, with the text received so far in its body.
+        """
+        received = []
+        stop_reason = []
+        usage = {}
+
+        def call():
+            del received[:], stop_reason[:]
+            usage.clear()
+            response = self.client.invoke_model_with_response_stream(
+                modelId=model_id,
+                body=json.dumps(body),
+                contentType='application/json',
+                accept='application/json'
+            )
+            for event in response['body']:
+                if 'chunk' not in event:
+                    continue
+                data = json.loads(event['chunk']['bytes'])
+                if data.get('type') == 'content_block_delta':
+                    text = data['delta'].get('text', '')
+                    received.append(text)
+                    on_text(text)
+                elif data.get('type') == 'message_start':
+                    usage.update(data['message'].get('usage', {}))
+                elif data.get('type') == 'message_delta':
+                    stop_reason.append(data['delta'].get('stop_reason'))
+                    usage.update(data.get('usage', {}))
+            return streamed_body()
+
+        def streamed_body():
+            return {
+                "content": [{"type": "text", "text": ''.join(received)}],
+                "stop_reason": stop_reason[-1] if stop_reason else None,
+                "usage": dict(usage)
+            }
+
+        return self._run(call, partial=lambda: streamed_body() if received else None)
+
+    def _run(self, call, partial=None):
+        """Run call() under the rate limit and concurrency cap, retrying transient errors"""
+        error = None
+        for attempt in range(1, self.max_attempts + 1):
+            self.bucket.acquire()
+            with self._slots:
+                try:
+                    result = call()
+                except ClientError as e:
+                    code = e.response.get('Error', {}).get('Code')
+                    error = f"{code}: {e}"
+                    retryable = code in RETRYABLE_ERRORS
+                    throttled = code in THROTTLING_ERRORS
+                except BotoCoreError as e:
+                    # Connection resets, read timeouts and the like
+                    error = str(e)
+                    retryable, throttled = True, False
+                else:
+                    self.bucket.succeeded()
+                    self._count(calls=1, retries=attempt - 1)
+                    return InvocationResult(True, body=result, attempts=attempt)
+
+            if throttled:
+                self.bucket.throttled()
+                self._count(throttles=1)
+            received = partial() if partial else None
+            if received is not None:
+                self._count(calls=1, retries=attempt - 1, failures=1)
+                logger.error(f"Bedrock stream failed part way through: {error}")
+                return InvocationResult(False, body=received, error=error, attempts=attempt)
+            if not retryable or attempt == self.max_attempts:
+                break
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+            logger.warning(f"Bedrock attempt {attempt} failed ({error}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+        self._count(calls=1, retries=attempt - 1, failures=1)
+        logger.error(f"Bedrock call failed after {attempt} attempts: {error}")
+        return InvocationResult(False, error=error, attempts=attempt)
+
+    def _count(self, calls=0, throttles=0, retries=0, failures=0):
+        with self._lock:
+            self.calls += calls
+            self.throttles += throttles
+            self.retries += retries
+            self.failures += failures
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "throttles": self.throttles,
+                "retries": self.retries,
+                "failures": self.failures,
+                "rate": round(self.bucket.rate, 3)
+            }
+
+
+_invokers = {}
+_invokers_lock = threading.Lock()
+
+
+def get_invoker(region_name='us-east-1', **options):
+    """The process-wide invoker for a region; options only apply when it is first created"""
+    with _invokers_lock:
+        if region_name not in _invokers:
+            _invokers[region_name] = BedrockInvoker(region_name, **options)
+        return _invokers[region_name]
@@ -1,5 +1,4 @@
 #book_digitizer.py
-import boto3
 import re
 from botocore.exceptions import ClientError
 from pathlib import Path
@@ -12,14 +11,50 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Stages built from the parsed batches, redone whenever a batch is newly parsed
+STAGES_AFTER_OCR = ('ocr', 'link_images', 'chapters', 'book', 'search_index')
+
 class BookDigitizer:
-    def __init__(self, source_pdf, book_name, gcs_bucket_name):
+    def __init__(self, source_pdf, book_name, gcs_bucket_name, ocr_workers=4,
+                 llm_workers=4, chapter_mode="sequential", ocr_cache=None, llm_cache=None,
+                 ocr_engine="google-vision", ocr_fallback_engine=None, ocr_routes=None,
+                 ocr_min_confidence=0.5, ocr_engine_options=None, ocr_layout=False,
+                 llm_token_budget=6000, text_cleanup=True, llm_skip_trivial=True, llm_stream=False,
+                 llm_model_id='anthropic.claude-3-sonnet-20240229-v1:0', llm_prompt_caching=False,
+                 transfer_workers=16):
         """
         Args:
             source_pdf: Original pdf before it is split
             book_name: Name for the book
             gcs_bucket_name: Google Cloud Storage bucket name
+            ocr_workers: Number of batches to OCR concurrently ahead of the LLM
+            llm_workers: Number of concurrent LLM calls in two_phase mode
+            chapter_mode: "sequential" threads the chapter from batch to batch,
+                "two_phase" parses the TOC batch first, then all other batches
+                in parallel, and reconciles chapters afterwards
+            ocr_cache: Optional OCR result cache shared by the OCR processors
+            llm_cache: Optional Bedrock response cache for the LLM parser
+            ocr_engine: Default OCR engine name (see src.ocr_router.OCR_ENGINES)
+            ocr_fallback_engine: Engine for pages that come back empty or with
+                confidence below ocr_min_confidence
+            ocr_routes: Per page-range engine overrides, e.g. "1-40:textract"
+            ocr_min_confidence: Confidence below which a page is re-OCR'd
+            ocr_engine_options: {engine name: constructor keyword arguments}
+            ocr_layout: Use OCR geometry to drop running headers and page numbers,
+                tag footnotes and marginalia, and fix column reading order
+            llm_token_budget: Estimated output tokens per Bedrock request; the
+                pages of a batch are packed into requests of about this size
+            text_cleanup: Normalize OCR text (src.text_cleanup) before the LLM sees it
+            llm_skip_trivial: Build blank, image-only and plain prose pages
+                without Bedrock (see src.page_classifier)
+            llm_stream: Stream Bedrock responses, handling each page as it closes
+            llm_model_id: Bedrock model for page parsing
+            llm_prompt_caching: Use Bedrock prompt caching for the static prompt
+                instructions (needs a model that supports it)
+            transfer_workers: Concurrent S3 requests for bulk uploads, downloads and copies
         """
+        if chapter_mode not in ("sequential", "two_phase"):
+            raise ValueError(f"Unknown chapter_mode: {chapter_mode}")
         self.source_pdf = source_pdf
         if not self.source_pdf.exists():
             raise FileNotFoundError(f"PDF not found at: {self.source_pdf.resolve()}")
@@ -28,74 +63,211 @@ class BookDigitizer:
         self.pdf_url = None
         self.parsed_book = None
         self.bucket_name = "book-digitization"
-        self.s3 = boto3.client('s3')
+        # Every stage shares one pooled client and transfer thread pool
+        from src.s3_transfer import S3Transfer
+        self.transfer = S3Transfer(self.bucket_name, max_workers=transfer_workers)
+        self.s3 = self.transfer.client
+        # S3 caches are built before the digitizer; give them its client and report too
+        for cache in (ocr_cache, llm_cache):
+            if hasattr(cache, 'use_transfer'):
+                cache.use_transfer(self.transfer)
         self.batch_metadata = []
-        self.parsed_content = []
+        from src.page_store import PageStore
+        self.page_store = PageStore()
+        self.ocr_workers = max(1, ocr_workers)
+        self.llm_workers = max(1, llm_workers)
+        self.chapter_mode = chapter_mode
+        self.ocr_cache = ocr_cache
+        self.ocr_engine = ocr_engine
+        self.ocr_fallback_engine = ocr_fallback_engine
+        self.ocr_routes = ocr_routes
+        self.ocr_min_confidence = ocr_min_confidence
+        self.ocr_engine_options = ocr_engine_options or {}
+        self.ocr_layout = ocr_layout
+        
+        # Run progress, for resuming after a restart
+        from src.manifest import RunManifest
+        self.manifest = RunManifest(self.transfer, self.book_name)
         
         # LLM Parser
         from src.llm_parser import LLMParser
-        self.llm_parser = LLMParser()
+        self.llm_parser = LLMParser(cache=llm_cache, model_id=llm_model_id, token_budget=llm_token_budget,
+                                    skip_trivial=llm_skip_trivial, stream=llm_stream,
+                                    prompt_caching=llm_prompt_caching)
+        
+        from src.text_cleanup import TextCleaner
+        self.text_cleaner = TextCleaner() if text_cleanup else None
         
         # Chapter tracking
         self.toc_mapping = {}
         self.current_chapter = None
+        self.chapter_files = None
+        self._chapter_writer = None
+        self._page_images = None
+        self._parsing_batch = None  # (index, first page) of the batch with the LLM, sequential mode
 
     def _sanitize(self, name: str) -> str:
         """Clean book name"""
         return re.sub(r'[^a-zA-Z0-9_\-]', '-', name.strip().lower())
 
-    def batch_and_upload_pdf(self, batch_size=20, expiration=3600):
+    def run_config(self, **extra):
         """
-        Split PDF into batches, upload each to S3, and track page ranges + URLs.
+        Settings that change what the pipeline writes, for the run manifest.
+        Prompt templates are included by hash, so editing one starts a new run.
         
         Args:
-            batch_size: number of pages to include in a batch
+            extra: Settings decided outside the digitizer, e.g. the image source
         """
-        try:
-            input_pdf = PdfReader(self.source_pdf)
-        except:
-            logger.warning("PdfReader doesn't work in the container")
-
-        num_batches = (len(input_pdf.pages) + batch_size - 1) // batch_size
-
-        for b in range(num_batches):
-            writer = PdfWriter()
-            start_page = b * batch_size
-            end_page = min(start_page + batch_size, len(input_pdf.pages))
-
-            for i in range(start_page, end_page):
-                writer.add_page(input_pdf.pages[i])
-
-            batch_filename = f"{self.source_pdf.stem}-batch-{b+1}.pdf"
-            batch_path = self.source_pdf.parent / batch_filename
-            s3_key = f"{self.book_name}/input/batches/{batch_filename}"
+        from src.cache import make_cache_key
+        from src.llm_parser import PROMPT_DIR
+        config = {
+            "chapter_mode": self.chapter_mode,
+            "ocr_engine": self.ocr_engine,
+            "ocr_fallback_engine": self.ocr_fallback_engine,
+            "ocr_routes": self.ocr_routes,
+            "ocr_min_confidence": self.ocr_min_confidence,
+            "ocr_layout": self.ocr_layout,
+            "text_cleanup": self.text_cleaner is not None,
+            "llm_model_id": self.llm_parser.model_id,
+            "llm_token_budget": self.llm_parser.token_budget,
+            "llm_skip_trivial": self.llm_parser.skip_trivial,
+            "prompts": make_cache_key(*(path.read_bytes() for path in sorted(PROMPT_DIR.glob('*.txt'))))
+        }
+        config.update(extra)
+        return config
 
-            with open(batch_path, 'wb') as f:
-                writer.write(f)
+    def resume_run(self, batch_size, source_id=None, config=None):
+        """
+        Load the run manifest left by a previous attempt, if any.
+        
+        Restores batch_metadata when the same source PDF was already split
+        with the same batch_size and config; otherwise the manifest is reset
+        and the run starts over. Returns True if there is progress to resume from.
+        
+        Args:
+            batch_size: Batch size this run will split with
+            source_id: Identifies the source PDF version, e.g. its S3 ETag
+            config: This run's settings, as returned by run_config()
+        """
+        if not self.manifest.load():
+            self.manifest.reset(source_id, config)
+            return False
+        
+        if self.manifest.data.get('source_id') != source_id:
+            logger.warning("Source PDF changed since the last run, starting over")
+            self.manifest.reset(source_id, config)
+            return False
+        
+        if self.manifest.data.get('batch_size') not in (None, batch_size):
+            logger.warning(f"Batch size changed from {self.manifest.data['batch_size']} to {batch_size}, "
+                           f"starting over")
+            self.manifest.reset(source_id, config)
+            return False
+        
+        previous = self.manifest.data.get('config') or {}
+        changed = sorted(name for name in set(previous) | set(config or {})
+                         if previous.get(name) != (config or {}).get(name))
+        if changed:
+            logger.warning(f"Settings changed since the last run ({', '.join(changed)}), starting over")
+            self.manifest.reset(source_id, config)
+            return False
+        
+        if self.manifest.is_stage_complete('split'):
+            self.batch_metadata = list(self.manifest.data['batch_metadata'])
+        logger.info(f"Resuming run with {len(self.manifest.completed_batches())} of "
+                    f"{len(self.batch_metadata)} batches already parsed")
+        return True
 
+    def batch_and_upload_pdf(self, batch_size=20, expiration=3600, upload_workers=2):
+        """
+        Split PDF into batches, upload each to S3, and track page ranges + URLs.
+        
+        Batches are written to in-memory buffers and uploaded in the background
+        while the next batch is split. At most `upload_workers` batches are held
+        in memory at once. PdfReader keeps every object it has resolved, so each
+        batch is read with a fresh reader; memory then follows the batch size,
+        not the size of the book.
+        
+        Args:
+            batch_size: number of pages to include in a batch
+            upload_workers: number of batches uploading concurrently
+        """
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        import io
+        
+        # Pass an open file rather than a path: given a path, PdfReader reads
+        # the whole file into memory, given a file it reads objects on demand
+        with open(self.source_pdf, 'rb') as source, \
+                ThreadPoolExecutor(max_workers=upload_workers) as pool:
             try:
-                self.s3.upload_file(str(batch_path), self.bucket_name, s3_key)
-            except ClientError as e:
-                logger.error(f"Upload failed: {e}")
+                num_pages = len(PdfReader(source).pages)
+            except Exception:
+                logger.warning("PdfReader doesn't work in the container")
                 raise
-            os.remove(batch_path)
             
-            s3_uri = f"s3://{self.bucket_name}/{s3_key}"
-
-            self.batch_metadata.append({
-                "s3_uri": s3_uri,
-                "start_page": start_page + 1,
-                "end_page": end_page 
-            })
+            num_batches = (num_pages + batch_size - 1) // batch_size
+            uploads = deque()
+            
+            for b in range(num_batches):
+                # Only the xref is re-read; the previous reader's objects are freed
+                input_pdf = PdfReader(source)
+                writer = PdfWriter()
+                start_page = b * batch_size
+                end_page = min(start_page + batch_size, num_pages)
+                
+                for i in range(start_page, end_page):
+                    writer.add_page(input_pdf.pages[i])
+                
+                batch_filename = f"{self.source_pdf.stem}-batch-{b+1}.pdf"
+                s3_key = f"{self.book_name}/input/batches/{batch_filename}"
+                
+                buffer = io.BytesIO()
+                writer.write(buffer)
+                buffer.seek(0)
+                
+                # Bound memory: wait for the oldest upload before queueing another
+                if len(uploads) >= upload_workers:
+                    uploads.popleft().result()
+                uploads.append(pool.submit(
+                    self._upload_batch, buffer, s3_key,
+                    f"batch {b+1}: pages {start_page}–{end_page - 1}"
+                ))
+                
+                s3_uri = f"s3://{self.bucket_name}/{s3_key}"
+                
+                self.batch_metadata.append({
+                    "s3_uri": s3_uri,
+                    "start_page": start_page + 1,
+                    "end_page": end_page 
+                })
+            
+            while uploads:
+                uploads.popleft().result()
+        
+        self.manifest.set_batches(batch_size, self.batch_metadata)
 
-            logger.info(f"Uploaded batch {b+1}: pages {start_page}–{end_page - 1}")
+    def _upload_batch(self, buffer, s3_key, description):
+        """Upload one in-memory batch PDF, multipart if it is large"""
+        try:
+            self.transfer.upload_fileobj(buffer, s3_key, content_type='application/pdf')
+        except ClientError as e:
+            logger.error(f"Upload failed: {e}")
+            raise
+        finally:
+            buffer.close()
+        logger.info(f"Uploaded {description}")
 
-    def extract_and_upload_images(self):
+    def extract_and_upload_images(self, chunk_pages=20, workers=4):
         """
         Extract images from the original PDF using Mistral OCR and upload to S3
+        
+        The book is sent in page ranges of chunk_pages, up to `workers` at a
+        time; each range's images are decoded and uploaded as soon as it
+        returns, so only the in-flight ranges are held in memory.
         """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
         from mistralai import Mistral
-        import base64
         
         # Generate presigned URL for the original PDF
         pdf_key = f'{self.book_name}/input/full_book.pdf'
@@ -104,61 +276,97 @@ class BookDigitizer:
             Params={'Bucket': self.bucket_name, 'Key': pdf_key},
             ExpiresIn=3600
         )
-    
-        # Process with Mistral OCR
+        
+        with open(self.source_pdf, 'rb') as f:
+            total_pages = len(PdfReader(f).pages)
+        
+        # Mistral numbers pages from 0
+        chunks = [list(range(start, min(start + chunk_pages, total_pages)))
+                  for start in range(0, total_pages, chunk_pages)]
+        
         client = Mistral(api_key=os.environ["MISTRAL_API_KEY"])
+        image_count = 0
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {
+                pool.submit(self._extract_image_chunk, client, presigned_url, pages): pages
+                for pages in chunks
+            }
+            for future in as_completed(futures):
+                pages = futures[future]
+                try:
+                    image_count += future.result()
+                except Exception as e:
+                    logger.error(f"Image extraction failed for pages {pages[0] + 1}-{pages[-1] + 1}: {e}")
+                    errors.append(e)
+        
+        if errors:
+            raise errors[0]
+        
+        logger.info(f"Extracted and uploaded {image_count} images")
+
+    def _extract_image_chunk(self, client, document_url, pages):
+        """OCR one page range with Mistral and upload its images; returns the image count"""
+        import base64
+        
         ocr_response = client.ocr.process(
             model="mistral-ocr-latest",
-            document={"type": "document_url", "document_url": presigned_url},
+            document={"type": "document_url", "document_url": document_url},
+            pages=pages,
             include_image_base64=True
         )
-    
-        ocr_response = ocr_response.model_dump()
         
-        # Extract and upload images
-        image_count = 0
-        for page_idx, page in enumerate(ocr_response['pages']):
-            if 'images' in page:
-                for img_idx, img_data in enumerate(page['images']):
-                    # Decode base64 image
-                    encoded = img_data['image_base64'].split(",", 1)[1]
-                    decoded = base64.b64decode(encoded)
-                    
-                    filename = f"page_{page_idx + 1}_image_{img_idx + 1}.jpg"
-                    s3_key = f"{self.book_name}/output/images/{filename}"
-                    
-                    # Upload to S3
-                    self.s3.put_object(
-                        Bucket=self.bucket_name, 
-                        Key=s3_key, 
-                        Body=decoded, 
-                        ContentType="image/jpeg"
-                    )
-                    
-                    image_count += 1
-                    logger.info(f"Uploaded image: {s3_key}")
+        # Decode the range's images and upload them together
+        uploads = []
+        for page in ocr_response.pages:
+            for img_idx, img_data in enumerate(page.images or []):
+                encoded = img_data.image_base64.split(",", 1)[1]
+                filename = f"page_{page.index + 1}_image_{img_idx + 1}.jpg"
+                s3_key = f"{self.book_name}/output/images/{filename}"
+                uploads.append((s3_key, base64.b64decode(encoded), "image/jpeg"))
         
+        self.transfer.put_many(uploads)
+        logger.info(f"Uploaded {len(uploads)} images for pages {pages[0] + 1}-{pages[-1] + 1}")
+        return len(uploads)
+
+    def extract_images_locally(self, max_scanned_share=0.5, chunk_pages=20, workers=4, **options):
+        """
+        Extract the images embedded in the original PDF without Mistral OCR,
+        dropping page scans, blank plates and near-duplicates (see
+        src.image_extraction for options).
+
+        Illustrations inside a page scan are not separate images, so a book
+        that is mostly scans goes to extract_and_upload_images instead.
+
+        Args:
+            max_scanned_share: Share of scanned pages above which Mistral OCR is used
+            chunk_pages, workers: Passed to extract_and_upload_images in that case
+        """
+        from src.image_extraction import LocalImageExtractor
+
+        extractor = LocalImageExtractor(self.transfer, self.book_name, **options)
+        scanned_share = extractor.scanned_share(self.source_pdf)
+        if scanned_share > max_scanned_share:
+            logger.warning(f"{scanned_share:.0%} of pages are page scans, whose illustrations local "
+                           f"extraction cannot crop; using Mistral OCR for images instead")
+            return self.extract_and_upload_images(chunk_pages=chunk_pages, workers=workers)
+
+        image_count = extractor.extract(self.source_pdf)
         logger.info(f"Extracted and uploaded {image_count} images")
+        return image_count
 
     def process_batch_with_llm(self, ocr_output, batch_start_page, batch_end_page, is_first_batch=False):
         """Process batch using LLM parser"""
         
-        if is_first_batch:
-            parsed_data = self.llm_parser.parse_first_batch(
-                ocr_output,
-                batch_start_page,
-                batch_end_page,
-                self.book_name
-            )
-        else:
-            parsed_data = self.llm_parser.parse_subsequent_batch(
-                ocr_output,
-                batch_start_page,
-                batch_end_page,
-                self.book_name,
-                self.toc_mapping,
-                self.current_chapter
-            )
+        parsed_data = self.llm_parser.parse_batch(
+            ocr_output,
+            batch_start_page,
+            batch_end_page,
+            self.book_name,
+            first_batch=is_first_batch,
+            toc_mapping=self.toc_mapping,
+            current_chapter=self.current_chapter
+        )
         
         # Update context for next batch
         if parsed_data.get('toc_extracted'):
@@ -180,68 +388,338 @@ class BookDigitizer:
         else:
             data_dict = parsed_data
         
-        self.s3.put_object(
-            Bucket=self.bucket_name,
-            Key=output_key,
-            Body=json.dumps(data_dict, indent=2),
-            ContentType='application/json'
-        )
+        self.transfer.put(output_key, json.dumps(data_dict, indent=2), 'application/json')
         
         logger.info(f"Saved parsed content: {output_key}")
         return output_key
 
+    def _ocr_batch(self, processor, batch_meta):
+        """Run OCR for one batch and return its text, or None if OCR failed"""
+        s3_key = batch_meta['s3_uri'].replace(f"s3://{self.bucket_name}/", "")
+        ocr_output_key = processor.process_batch(
+            s3_key, 
+            batch_meta['start_page'], 
+            batch_meta['end_page']
+        )
+        if not ocr_output_key:
+            return None
+        
+        ocr_text = self.transfer.get(ocr_output_key).decode('utf-8')
+        if self.text_cleaner is not None:
+            ocr_text = self.text_cleaner.clean(ocr_text)
+        return ocr_text
+
     def process_with_ocr(self):
-        """Enhanced version that includes OCR and LLM processing"""
-        from src.google_vision_processor import GoogleVisionProcessor
-        processor = GoogleVisionProcessor(self.bucket_name, self.gcs_bucket_name, self.book_name)
+        """
+        Enhanced version that includes OCR and LLM processing
         
-        for i, batch_meta in enumerate(self.batch_metadata):
-            s3_key = batch_meta['s3_uri'].replace(f"s3://{self.bucket_name}/", "")
-            
-            # Get OCR output
-            ocr_output_key = processor.process_batch(
-                s3_key, 
-                batch_meta['start_page'], 
-                batch_meta['end_page']
+        Batches already recorded in the run manifest are loaded from S3
+        instead of being OCR'd and parsed again. Returns the 1-based numbers
+        of batches that are still not parsed, e.g. because their OCR failed.
+        """
+        from src.ocr_router import OCRRouter, parse_engine_routes
+        processor = OCRRouter(
+            self.bucket_name,
+            self.book_name,
+            engine=self.ocr_engine,
+            fallback_engine=self.ocr_fallback_engine,
+            routes=parse_engine_routes(self.ocr_routes),
+            min_confidence=self.ocr_min_confidence,
+            gcs_bucket_name=self.gcs_bucket_name,
+            cache=self.ocr_cache,
+            engine_options=self.ocr_engine_options,
+            layout=self.ocr_layout,
+            transfer=self.transfer
+        )
+        
+        # Images are extracted before OCR, so pages can be linked as they are parsed
+        page_images = self._list_page_images()
+        self._page_images = page_images
+        self.llm_parser.page_listener = self._on_page_parsed
+        
+        # Chapter files are written as the batches that finish them come in
+        from src.chapter_writer import ChapterWriter
+        self._chapter_writer = ChapterWriter(self.transfer, f"{self.book_name}/output/chapters")
+        
+        done = self._load_completed_batches()
+        try:
+            if self.chapter_mode == "two_phase":
+                self._process_two_phase(processor, done)
+            else:
+                self._process_sequential(processor, done)
+        finally:
+            processor.close()
+        self.chapter_files = self._chapter_writer.close()
+        self.save_page_store()
+        
+        logger.info(f"OCR routing: {processor.stats()}")
+        if self.ocr_cache is not None:
+            logger.info(f"OCR cache: {self.ocr_cache.stats()}")
+        if self.text_cleaner is not None:
+            self._save_cleanup_report()
+        logger.info(f"LLM requests: {self.llm_parser.stats()}")
+        if self.llm_parser.cache is not None:
+            logger.info(f"LLM cache: {self.llm_parser.cache_stats()}")
+        
+        parsed = self.manifest.completed_batches()
+        return [n for n in range(1, len(self.batch_metadata) + 1) if n not in parsed]
+
+    def _save_cleanup_report(self):
+        """Log and save how much text cleanup removed before the LLM"""
+        report = self.text_cleaner.report()
+        logger.info(f"Text cleanup: {report}")
+        self.transfer.put(f"{self.book_name}/output/reports/text_cleanup.json",
+                          json.dumps(report, indent=2), 'application/json')
+
+    def save_transfer_report(self):
+        """Log and save the run's S3 request counts, latencies and throughput"""
+        report = self.transfer.report()
+        logger.info(f"S3 transfers: {report}")
+        self.transfer.put(f"{self.book_name}/output/reports/s3_transfer.json",
+                          json.dumps(report, indent=2), 'application/json')
+        return report
+
+    def _load_completed_batches(self):
+        """Parsed batches from the manifest, keyed by 0-based batch index"""
+        records = self.manifest.completed_batches()
+        bodies = self.transfer.get_many(record['parsed_key'] for record in records.values())
+        done = {
+            batch_num - 1: json.loads(bodies[record['parsed_key']])
+            for batch_num, record in records.items()
+        }
+        if done:
+            logger.info(f"Loaded {len(done)} parsed batches from previous run")
+        return done
+
+    def _checkpoint_batch(self, parsed_data, batch_num, current_chapter):
+        """Save a parsed batch to S3 and record it in the manifest"""
+        output_key = self.save_parsed_content(parsed_data, batch_num)
+        new = batch_num not in self.manifest.completed_batches()
+        self.manifest.complete_batch(batch_num, output_key, self.toc_mapping, current_chapter)
+        # Chapters, book and index built without this batch are out of date
+        if new:
+            self.manifest.clear_stages(STAGES_AFTER_OCR)
+
+    def _emit_batch(self, i, parsed_data):
+        """Add a finished batch to the page store and chapter writer; None for a failed batch"""
+        if parsed_data is None:
+            self._chapter_writer.skip(i)
+            return
+        
+        # Batches from an earlier run were parsed before their images were linked
+        if self._page_images:
+            changed = [self._link_page_images(page, self._page_images) for page in parsed_data.get('pages', [])]
+            if any(changed):
+                self.save_parsed_content(parsed_data, i + 1)
+        self._chapter_writer.add_batch(i, self.page_store.add_batch(i, parsed_data))
+
+    def save_page_store(self):
+        """Save every parsed page as one JSONL artifact"""
+        key = f"{self.book_name}/output/parsed/pages.jsonl"
+        self.transfer.put(key, self.page_store.to_jsonl(), 'application/x-ndjson')
+        logger.info(f"Saved {len(self.page_store)} pages: {key}")
+
+    def _load_page_store(self):
+        """Fill the page store from the saved JSONL, or else the manifest's parsed batches"""
+        from src.page_store import PageStore
+        try:
+            self.page_store = PageStore.from_jsonl(
+                self.transfer.get(f"{self.book_name}/output/parsed/pages.jsonl").decode('utf-8')
             )
+        except ClientError as e:
+            logger.info(f"No saved page store ({e}), loading parsed batches")
+            for i, parsed_data in self._load_completed_batches().items():
+                self.page_store.add_batch(i, parsed_data)
+
+    def _process_sequential(self, processor, done):
+        """
+        OCR batches concurrently and parse them with the LLM in batch order.
+        
+        OCR for the next `ocr_workers` batches runs in a thread pool while the
+        current batch is with the LLM. LLM calls stay sequential because each
+        batch needs the chapter context left by the one before it.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        
+        records = self.manifest.completed_batches()
+        todo = [i for i in range(len(self.batch_metadata)) if i not in done]
+        
+        with ThreadPoolExecutor(max_workers=self.ocr_workers) as pool:
+            pending = {}
+            submitted = 0
+            position = 0
             
-            if ocr_output_key:
-                # Get OCR content
-                ocr_response = self.s3.get_object(Bucket=self.bucket_name, Key=ocr_output_key)
-                ocr_output = ocr_response['Body'].read().decode('utf-8')
+            for i, batch_meta in enumerate(self.batch_metadata):
+                if i in done:
+                    # Pick up the chapter context this batch left behind
+                    self.toc_mapping = dict(records[i + 1]['toc_mapping'])
+                    self.current_chapter = records[i + 1]['current_chapter']
+                    self._emit_batch(i, done[i])
+                    continue
                 
-                # Process with LLM
-                parsed_data = self.process_batch_with_llm(
+                # Keep the OCR window full: this batch plus the next ocr_workers
+                while submitted < len(todo) and submitted <= position + self.ocr_workers:
+                    j = todo[submitted]
+                    pending[j] = pool.submit(self._ocr_batch, processor, self.batch_metadata[j])
+                    submitted += 1
+                position += 1
+                
+                ocr_output = pending.pop(i).result()
+                if ocr_output is None:
+                    logger.warning(f"OCR failed for batch {i+1}, skipping")
+                    self._emit_batch(i, None)
+                    continue
+                
+                # Process with LLM; pages it finishes go on to the chapter writer
+                self._parsing_batch = (i, batch_meta['start_page'])
+                try:
+                    parsed_data = self.process_batch_with_llm(
+                        ocr_output,
+                        batch_meta['start_page'],
+                        batch_meta['end_page'],
+                        is_first_batch=(i == 0)
+                    )
+                finally:
+                    self._parsing_batch = None
+                
+                # Save parsed content
+                self._checkpoint_batch(parsed_data, i + 1, self.current_chapter)
+                self._emit_batch(i, parsed_data.model_dump() if hasattr(parsed_data, 'model_dump') else parsed_data)
+
+    def _process_two_phase(self, processor, done):
+        """
+        Parse the TOC batch first, then all remaining batches in parallel.
+        
+        Remaining batches only see the TOC mapping, not the previous batch's
+        chapter; pages without their own chapter evidence are filled in by
+        reconcile_chapters once every batch is back.
+        """
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        
+        if not self.batch_metadata:
+            return
+        
+        results = [done.get(i) for i in range(len(self.batch_metadata))]
+        if 0 in done:
+            self.toc_mapping.update(self.manifest.completed_batches()[1]['toc_mapping'])
+        for i in sorted(done):
+            self._emit_batch(i, done[i])
+        
+        with ThreadPoolExecutor(max_workers=self.ocr_workers) as ocr_pool, \
+                ThreadPoolExecutor(max_workers=self.llm_workers) as llm_pool:
+            ocr_futures = {
+                ocr_pool.submit(self._ocr_batch, processor, batch_meta): i
+                for i, batch_meta in enumerate(self.batch_metadata)
+                if i not in done
+            }
+            
+            # Phase 1: TOC extraction from the first batch
+            if 0 not in done:
+                first_future = next(f for f, i in ocr_futures.items() if i == 0)
+                first_output = first_future.result()
+                if first_output is None:
+                    logger.warning("OCR failed for batch 1, continuing without TOC")
+                else:
+                    first_meta = self.batch_metadata[0]
+                    results[0] = self.process_batch_with_llm(
+                        first_output,
+                        first_meta['start_page'],
+                        first_meta['end_page'],
+                        is_first_batch=True
+                    )
+                    self._checkpoint_batch(results[0], 1, self.current_chapter)
+                self._emit_batch(0, results[0])
+            toc_mapping = dict(self.toc_mapping)
+            
+            # Phase 2: every other batch as soon as its OCR is done.
+            # Failures are raised only after every finished batch is checkpointed.
+            errors = []
+            llm_futures = {}
+            for future in as_completed(ocr_futures):
+                i = ocr_futures[future]
+                if i == 0:
+                    continue
+                try:
+                    ocr_output = future.result()
+                except Exception as e:
+                    logger.error(f"OCR failed for batch {i+1}: {e}")
+                    errors.append(e)
+                    self._emit_batch(i, None)
+                    continue
+                if ocr_output is None:
+                    logger.warning(f"OCR failed for batch {i+1}, skipping")
+                    self._emit_batch(i, None)
+                    continue
+                batch_meta = self.batch_metadata[i]
+                llm_futures[llm_pool.submit(
+                    self.llm_parser.parse_batch,
                     ocr_output,
                     batch_meta['start_page'],
                     batch_meta['end_page'],
-                    is_first_batch=(i == 0)
-                )
-                
-                # Save parsed content
-                self.save_parsed_content(parsed_data, i + 1)
-                self.parsed_content.append(parsed_data.model_dump() if hasattr(parsed_data, 'model_dump') else parsed_data)
+                    self.book_name,
+                    toc_mapping=toc_mapping,
+                    defer_carryover=True
+                )] = i
+            
+            # Checkpoint unreconciled batches as they land so a restart keeps them
+            for future in as_completed(llm_futures):
+                i = llm_futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    logger.error(f"LLM parsing failed for batch {i+1}: {e}")
+                    errors.append(e)
+                    self._emit_batch(i, None)
+                    continue
+                self._checkpoint_batch(results[i], i + 1, None)
+                # Pages without a chapter continue the one before, as reconcile_chapters will have it
+                self._emit_batch(i, results[i])
+        
+        if errors:
+            raise errors[0]
+        
+        for parsed_data in results[1:]:
+            if parsed_data and parsed_data.get('toc_extracted'):
+                self.toc_mapping.update(parsed_data['toc_extracted'])
+        
+        unresolved = [
+            i for i, parsed_data in enumerate(results)
+            if parsed_data and any(page.get('chapter') is None for page in parsed_data.get('pages', []))
+        ]
+        self.reconcile_chapters([r for r in results if r is not None])
+        
+        # Save the batches reconciliation filled in
+        for i in unresolved:
+            last_chapter = results[i]['pages'][-1]['chapter']
+            self._checkpoint_batch(results[i], i + 1, last_chapter)
+            self.page_store.add_batch(i, results[i])
 
-    def link_images_to_content(self):
-        """Update parsed content with actual image URLs"""
-        # Get list of uploaded images
+    def reconcile_chapters(self, batches):
+        """Fill in chapter for pages that only continue the current chapter"""
+        current_chapter = self.current_chapter
+        for batch in batches:
+            for page in batch.get('pages', []):
+                if page.get('chapter') is None:
+                    page['chapter'] = current_chapter or "frontmatter"
+                current_chapter = page['chapter']
+        self.current_chapter = current_chapter
+
+    def _list_page_images(self):
+        """Uploaded images by page number, or None if there are none"""
         image_prefix = f"{self.book_name}/output/images/"
         try:
-            image_objects = self.s3.list_objects_v2(
-                Bucket=self.bucket_name,
-                Prefix=image_prefix
-            )
-        except:
-            logger.warning("No images found")
-            return
+            image_keys = self.transfer.list_keys(image_prefix)
+        except ClientError as e:
+            logger.warning(f"Could not list images: {e}")
+            return None
         
-        if 'Contents' not in image_objects:
-            return
+        if not image_keys:
+            return None
         
         # Create mapping of page numbers to images
         page_images = {}
-        for obj in image_objects['Contents']:
-            filename = obj['Key'].split('/')[-1]
+        for key in image_keys:
+            filename = key.split('/')[-1]
             if filename.startswith('page_'):
                 page_num = int(filename.split('_')[1])
                 if page_num not in page_images:
@@ -250,96 +728,104 @@ class BookDigitizer:
                     'filename': filename,
                     'url': f"images/{filename}"
                 })
-        
-        # Update parsed content
-        for i, batch in enumerate(self.parsed_content):
-            if isinstance(batch, dict) and 'pages' in batch:
-                for page in batch['pages']:
-                    if isinstance(page, dict) and 'page_number' in page:
-                        page_num = int(page['page_number'])
-                        if page_num in page_images:
-                            image_markdown = '\n'.join([
-                                f"![Image {j+1}]({img['url']})" 
-                                for j, img in enumerate(page_images[page_num])
-                            ])
-                            page['content'] = f"{image_markdown}\n\n{page['content']}"
-            
-            # Save updated content
-            self.save_parsed_content(batch, i + 1)
+        return page_images
 
-    def create_quarto_chapters(self):
-        """Create individual chapter files based on chapter_start markers"""
-        # Combine all pages from batches
-        all_pages = []
-        for batch in self.parsed_content:
-            all_pages.extend(batch.get('pages', []))
-        
-        # Group pages by chapter, handling multiple chapters per batch
-        chapters = {}
-        current_chapter = None
+    def _linked_content(self, page_num, content, page_images):
+        """Content with the page's images at the top, or None if there is nothing to add"""
+        images = page_images.get(page_num)
+        # Skip pages linked by an interrupted earlier run or as they were parsed
+        if not images or f"]({images[0]['url']})" in content:
+            return None
+        image_markdown = '\n'.join([
+            f"![Image {j+1}]({img['url']})" 
+            for j, img in enumerate(images)
+        ])
+        return f"{image_markdown}\n\n{content}"
+
+    def _on_page_parsed(self, page):
+        """Link a page's images and, in sequential mode, start writing its chapter"""
+        if self._page_images:
+            self._link_page_images(page, self._page_images)
+        if self._parsing_batch is not None and isinstance(page, dict):
+            from src.page_store import PageRecord
+            index, first_page = self._parsing_batch
+            self._chapter_writer.add_page(index, first_page, PageRecord.from_dict(page, index))
+
+    def _link_page_images(self, page, page_images):
+        """Put a parsed page dict's images at the top of its content, once; True if it changed"""
+        if isinstance(page, dict) and 'page_number' in page:
+            content = self._linked_content(int(page['page_number']), page['content'], page_images)
+            if content is not None:
+                page['content'] = content
+                return True
+        return False
+
+    def link_images_to_content(self):
+        """Update parsed content with actual image URLs"""
+        # Get list of uploaded images
+        page_images = self._list_page_images()
+        if not page_images:
+            return
+        if not len(self.page_store):
+            self._load_page_store()
         
-        for page in all_pages:
-            # Start new chapter if marked
-            if page.get('chapter_start', False):
-                current_chapter = page['chapter']
-                if current_chapter not in chapters:
-                    chapters[current_chapter] = []
-            
-            # Add page to current chapter
-            if current_chapter:
-                chapters[current_chapter].append(page)
+        # Look up each image's page; pages linked as they were parsed need no new save
+        changed_batches = set()
+        for page_num in page_images:
+            record = self.page_store.get(page_num)
+            if record is None:
+                continue
+            content = self._linked_content(page_num, record.content, page_images)
+            if content is not None:
+                record.content = content
+                changed_batches.add(record.batch)
         
-        # Save chapter files
-        for chapter_name, chapter_pages in chapters.items():
-            content = "\n\n".join([page['content'] for page in chapter_pages])
-            
-            chapter_key = f"{self.book_name}/output/chapters/{chapter_name}.qmd"
-            self.s3.put_object(
-                Bucket=self.bucket_name,
-                Key=chapter_key,
-                Body=content,
-                ContentType='text/markdown'
-            )
-            logger.info(f"Created chapter: {chapter_key}")
+        for batch in sorted(changed_batches):
+            self.save_parsed_content(self.page_store.batch_dict(batch), batch + 1)
+        if changed_batches:
+            self.save_page_store()
 
-    def create_quarto_book(self, output_dir="./quarto_book"):
-        """Download parsed content and create local Quarto book, then upload to S3"""
-        import os
-        import yaml
+    def create_quarto_chapters(self):
+        """
+        Chapter files for the parsed book; returns their file names in order.
         
-        os.makedirs(output_dir, exist_ok=True)
-        os.makedirs(f"{output_dir}/images", exist_ok=True)
+        process_with_ocr writes them as batches complete, so this only builds
+        them when the book was parsed by an earlier process.
+        """
+        if self.chapter_files is not None:
+            logger.info(f"{len(self.chapter_files)} chapters already written as batches completed")
+            return self.chapter_files
         
-        # Download all parsed JSON files
-        all_pages = []
-        for i in range(len(self.batch_metadata)):
-            try:
-                key = f"{self.book_name}/output/parsed/batch_{i+1}_parsed.json"
-                response = self.s3.get_object(Bucket=self.bucket_name, Key=key)
-                batch_data = json.loads(response['Body'].read())
-                if 'pages' in batch_data:
-                    all_pages.extend(batch_data['pages'])
-            except:
-                continue
+        if not len(self.page_store):
+            self._load_page_store()
         
-        # Group pages by chapter
+        # Pages are indexed by chapter; any left without one belong to the front matter
         chapters = {}
-        for page in all_pages:
-            chapter = page.get('chapter', 'frontmatter')
-            if chapter not in chapters:
-                chapters[chapter] = []
-            chapters[chapter].append(page['content'])
-        
-        # Create chapter files
-        chapter_files = []
-        for chapter_name, contents in chapters.items():
-            filename = f"{chapter_name}.qmd"
-            chapter_files.append(filename)
-            
-            with open(f"{output_dir}/{filename}", 'w') as f:
-                f.write('\n\n'.join(contents))
+        for chapter in self.page_store.chapters():
+            chapters.setdefault(chapter or 'frontmatter', []).extend(self.page_store.chapter_pages(chapter))
+        
+        self.transfer.put_many(
+            (f"{self.book_name}/output/chapters/{chapter}.qmd",
+             "\n\n".join(record.content for record in sorted(records, key=lambda r: r.page_number)),
+             'text/markdown')
+            for chapter, records in chapters.items()
+        )
+        self.chapter_files = [f"{chapter}.qmd" for chapter in chapters]
+        logger.info(f"Created {len(chapters)} chapters in {self.book_name}/output/chapters")
+        return self.chapter_files
+
+    def create_quarto_book(self, output_dir=None):
+        """
+        Assemble the Quarto book in S3 from the chapter files.
+        
+        Chapter files and images are copied server-side into the book's
+        quarto_book prefix next to a new _quarto.yml, so no book content is
+        downloaded or uploaded again.
         
-        # Create _quarto.yml
+        Args:
+            output_dir: Optional local directory to also write the text files to
+        """
+        chapter_files = self.create_quarto_chapters()
         config = {
             'project': {'type': 'book'},
             'book': {
@@ -348,33 +834,60 @@ class BookDigitizer:
             }
         }
         
-        with open(f"{output_dir}/_quarto.yml", 'w') as f:
-            yaml.dump(config, f)
+        chapters_prefix = f"{self.book_name}/output/chapters"
+        book_prefix = f"{self.book_name}/output/quarto_book"
+        self.transfer.copy_many(
+            (f"{chapters_prefix}/{filename}", f"{book_prefix}/{filename}") for filename in chapter_files
+        )
+        self.transfer.put(f"{book_prefix}/_quarto.yml", yaml.dump(config), 'application/x-yaml')
+        logger.info(f"Copied {len(chapter_files)} chapters to {book_prefix}")
         
-        # Download images
-        try:
-            objects = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix=f"{self.book_name}/output/images/")
-            for obj in objects.get('Contents', []):
-                filename = obj['Key'].split('/')[-1]
-                self.s3.download_file(self.bucket_name, obj['Key'], f"{output_dir}/images/{filename}")
-        except:
-            pass
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+            bodies = self.transfer.get_many(f"{chapters_prefix}/{filename}" for filename in chapter_files)
+            for filename in chapter_files:
+                with open(f"{output_dir}/{filename}", 'wb') as f:
+                    f.write(bodies[f"{chapters_prefix}/{filename}"])
+            with open(f"{output_dir}/_quarto.yml", 'w') as f:
+                yaml.dump(config, f)
         
-        # Upload complete Quarto book to S3
-        self._upload_directory_to_s3(output_dir, f"{self.book_name}/output/quarto_book")
+        image_prefix = f"{self.book_name}/output/images/"
+        image_keys = self.transfer.list_keys(image_prefix)
+        self.transfer.copy_many(
+            (key, f"{book_prefix}/images/{key[len(image_prefix):]}") for key in image_keys
+        )
+        logger.info(f"Copied {len(image_keys)} images to {book_prefix}/images")
         
         logger.info("✅ BOOK DIGITIZATION COMPLETE!")
-        logger.info(f"📚 Quarto book created in {output_dir}")
-        logger.info("🚀 Starting preview server...")
-        logger.info(f"Manual command: cd {output_dir} && quarto preview")
-    
-    def _upload_directory_to_s3(self, local_dir, s3_prefix):
-        """Upload entire directory to S3"""
-        for root, dirs, files in os.walk(local_dir):
-            for file in files:
-                local_path = os.path.join(root, file)
-                relative_path = os.path.relpath(local_path, local_dir)
-                s3_key = f"{s3_prefix}/{relative_path}"
-                
-                self.s3.upload_file(local_path, self.bucket_name, s3_key)
-                logger.info(f"Uploaded: {s3_key}")
\ No newline at end of file
+        logger.info(f"📚 Quarto book created in s3://{self.bucket_name}/{book_prefix}")
+        logger.info(f"Manual command: aws s3 sync s3://{self.bucket_name}/{book_prefix} quarto_book "
+                    f"&& cd quarto_book && quarto preview")
+
+    def build_search_index(self, work_dir=None):
+        """
+        Build the full-text search index of the parsed pages (src.search_index)
+        and upload it next to the Quarto book; returns the index meta.
+        
+        Args:
+            work_dir: Local directory to build in; a temporary one by default
+        """
+        import tempfile
+        from src.search_index import INDEX_FILES, build_index
+        
+        if not len(self.page_store):
+            self._load_page_store()
+        
+        with tempfile.TemporaryDirectory(dir=work_dir) as index_dir:
+            meta = build_index(
+                ((self.book_name, record.page_number, record.chapter, record.content)
+                 for record in self.page_store),
+                index_dir
+            )
+            index_prefix = f"{self.book_name}/output/search_index"
+            for filename in INDEX_FILES:
+                content_type = 'application/json' if filename.endswith('.json') else 'application/x-ndjson'
+                with open(os.path.join(index_dir, filename), 'rb') as f:
+                    self.transfer.upload_fileobj(f, f"{index_prefix}/{filename}", content_type=content_type)
+        
+        logger.info(f"Uploaded search index to {index_prefix}")
+        return meta
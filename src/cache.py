@@ -0,0 +1,203 @@
+#cache.py
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import logging
+from pathlib import Path
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(*parts) -> str:
+    """Hash key parts (str or bytes) into a hex cache key"""
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode('utf-8')
+        digest.update(hashlib.sha256(part).digest())
+    return digest.hexdigest()
+
+
+def ocr_cache_key(pdf_data: bytes, engine_name: str, engine_version: str, start_page: int) -> str:
+    """
+    Key for an OCR result: batch PDF bytes plus engine name/version.
+
+    The start page is included because the cached text carries absolute
+    page numbers in its PAGE markers.
+    """
+    return make_cache_key("ocr", engine_name, engine_version, start_page, pdf_data)
+
+
+def llm_cache_key(model_id: str, temperature, prompt: str) -> str:
+    """Key for an LLM response: model id, temperature and the fully rendered prompt"""
+    prompt_hash = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    return make_cache_key("llm", model_id, temperature, prompt_hash)
+
+
+class LocalDiskCache:
+    """Byte cache in a local directory with size- and age-based eviction"""
+
+    def __init__(self, cache_dir, max_bytes=None, max_age_seconds=None):
+        """
+        Args:
+            cache_dir: Directory holding cache entries
+            max_bytes: Evict least recently used entries above this total size
+            max_age_seconds: Evict entries not used for longer than this
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / key
+
+    def get(self, key):
+        """Return cached bytes, or None on a miss"""
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Touch so eviction is least-recently-used
+        os.utime(path)
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, value: bytes):
+        """Store bytes under key, then evict if over limits"""
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Write then rename so readers never see a partial entry
+        tmp_path = path.with_name(f"{key}.{threading.get_ident()}.tmp")
+        tmp_path.write_bytes(value)
+        os.replace(tmp_path, path)
+
+        if self.max_bytes is not None or self.max_age_seconds is not None:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then oldest entries until under max_bytes"""
+        with self._lock:
+            now = time.time()
+            entries = []
+            for path in self.cache_dir.glob('*/*'):
+                if path.suffix == '.tmp':
+                    continue
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                if self.max_age_seconds is not None and now - stat.st_mtime > self.max_age_seconds:
+                    path.unlink(missing_ok=True)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            if self.max_bytes is None:
+                return
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+                logger.info(f"Evicted cache entry {path.name}")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class SQLiteCache:
+    """Byte cache in a single local SQLite file"""
+
+    def __init__(self, db_path):
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = str(db_path)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB, created REAL)"
+            )
+
+    def get(self, key):
+        """Return cached bytes, or None on a miss"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, value: bytes):
+        """Store bytes under key"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created) VALUES (?, ?, ?)",
+                (key, value, time.time())
+            )
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class S3Cache:
+    """Byte cache stored under an S3 prefix"""
+
+    def __init__(self, bucket_name, prefix, transfer=None):
+        """
+        Args:
+            transfer: src.s3_transfer.S3Transfer to share; one is created if not
+                given, and use_transfer() can swap it later
+        """
+        self.bucket_name = bucket_name
+        self.prefix = prefix.rstrip('/')
+        if transfer is None:
+            from src.s3_transfer import S3Transfer
+            transfer = S3Transfer(bucket_name)
+        self.use_transfer(transfer)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def use_transfer(self, transfer):
+        """Send this cache's requests through transfer's client, and into its report"""
+        self.transfer = transfer.for_bucket(self.bucket_name)
+
+    def get(self, key):
+        """Return cached bytes, or None on a miss"""
+        try:
+            data = self.transfer.get_if_exists(f"{self.prefix}/{key}")
+        except ClientError as e:
+            logger.warning(f"Cache read failed for {key}: {e}")
+            data = None
+        if data is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, value: bytes):
+        """Store bytes under key"""
+        self.transfer.put(f"{self.prefix}/{key}", value)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,114 @@
+#chapter_writer.py
+"""
+Writes chapter .qmd files while a book is still being parsed.
+
+Batches are fed in batch order (out-of-order arrivals wait for the batches
+before them). A chapter is uploaded as soon as a page of another chapter
+follows it, so only the open chapter is held in memory. Pages without a
+chapter continue the open one, as reconcile_chapters would have it.
+
+The next batch due can also be fed page by page while it is parsed
+(add_page); its pages are written once they run on from its first page,
+and add_batch then only adds the ones not seen yet.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ChapterWriter:
+    """
+    Incremental chapter files under one S3 prefix. Not thread-safe: feed it
+    from one thread.
+    """
+
+    def __init__(self, transfer, prefix):
+        """
+        Args:
+            transfer: src.s3_transfer.S3Transfer to upload with
+            prefix: Key prefix for the {chapter}.qmd files
+        """
+        self.transfer = transfer
+        self.prefix = prefix
+        self.chapters = []  # file names in order of first appearance
+        self._written = set()
+        self._pending = {}  # batch index -> pages, or None for a skipped batch
+        self._next = 0
+        self._early = {}  # page number -> PageRecord of the next batch, not yet in page order
+        self._early_next = None  # next page number of that batch to write
+        self._early_written = set()
+        self._open_chapter = None
+        self._open_parts = []
+        self.peak_buffered_chars = 0
+
+    def add_batch(self, index, pages):
+        """Take a batch's PageRecords (src.page_store); index is the 0-based batch number"""
+        self._pending[index] = pages
+        self._drain()
+
+    def add_page(self, index, first_page, page):
+        """
+        Take one finished PageRecord of batch index, whose first page is
+        first_page, before the whole batch is back. Ignored unless index is
+        the next batch due.
+        """
+        if index != self._next:
+            return
+        if self._early_next is None:
+            self._early_next = first_page
+        self._early[page.page_number] = page
+        while self._early_next in self._early:
+            self._add_page(self._early.pop(self._early_next))
+            self._early_written.add(self._early_next)
+            self._early_next += 1
+
+    def skip(self, index):
+        """Mark a batch that will never arrive, e.g. because its OCR failed"""
+        self.add_batch(index, None)
+
+    def _drain(self):
+        while self._next in self._pending:
+            pages = self._pending.pop(self._next)
+            written = self._early_written
+            self._next += 1
+            self._early, self._early_next, self._early_written = {}, None, set()
+            for page in pages or []:
+                if page.page_number not in written:
+                    self._add_page(page)
+
+    def _add_page(self, page):
+        chapter = page.chapter or self._open_chapter or 'frontmatter'
+        if chapter != self._open_chapter:
+            self._flush()
+            self._open_chapter = chapter
+            if f"{chapter}.qmd" in self._written:
+                # The chapter came back after another one; extend its file
+                self._open_parts.append(self.transfer.get(self._key(chapter)).decode('utf-8'))
+        self._open_parts.append(page.content)
+        self.peak_buffered_chars = max(self.peak_buffered_chars, sum(len(part) for part in self._open_parts))
+
+    def _key(self, chapter):
+        return f"{self.prefix}/{chapter}.qmd"
+
+    def _flush(self):
+        if self._open_chapter is None:
+            return
+        filename = f"{self._open_chapter}.qmd"
+        self.transfer.put(self._key(self._open_chapter), "\n\n".join(self._open_parts), 'text/markdown')
+        if filename not in self._written:
+            self._written.add(filename)
+            self.chapters.append(filename)
+        logger.info(f"Wrote chapter: {self._key(self._open_chapter)}")
+        self._open_chapter = None
+        self._open_parts = []
+
+    def close(self):
+        """Write whatever is still buffered, in batch order; returns the chapter file names"""
+        for index in sorted(self._pending):
+            for page in self._pending[index] or []:
+                self._add_page(page)
+        self._pending.clear()
+        self._flush()
+        logger.info(f"Wrote {len(self.chapters)} chapters, "
+                    f"at most {self.peak_buffered_chars} characters buffered")
+        return list(self.chapters)
@@ -1,61 +1,114 @@
 import json
+import re
+from array import array
 import time
+import uuid
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import vision
 from google.cloud import storage
-import boto3
+from src.cache import ocr_cache_key
+from src.ocr_pages import (
+    make_page, mean_confidence, format_pages, processed_text_key, save_processed_text,
+    load_cached_pages, store_cached_pages
+)
 
 logger = logging.getLogger(__name__)
 
+# Vision names output shards output-{first}-to-{last}.json
+SHARD_NAME = re.compile(r'output-(\d+)-to-(\d+)\.json$')
+
+# Symbol breaks that end a line
+LINE_BREAKS = ('EOL_SURE_SPACE', 'LINE_BREAK', 'HYPHEN')
+
 class GoogleVisionProcessor:
-    def __init__(self, s3_bucket_name, gcs_bucket_name, book_name):
+    ENGINE_NAME = "google-vision"
+    # Bump when the request features or text extraction change
+    ENGINE_VERSION = "document-text-detection-2"
+
+    def __init__(self, s3_bucket_name, gcs_bucket_name, book_name, cache=None, keep_geometry=False,
+                 transfer=None):
+        """
+        Args:
+            cache: Optional OCR result cache (see src.cache)
+            keep_geometry: Keep line boxes on each page for layout analysis
+            transfer: Shared src.s3_transfer.S3Transfer for s3_bucket_name; one
+                is created if not given
+        """
         self.s3_bucket_name = s3_bucket_name
         self.gcs_bucket_name = gcs_bucket_name
         self.book_name = book_name
-        self.s3 = boto3.client('s3')
+        self.cache = cache
+        self.keep_geometry = keep_geometry
+        if transfer is None:
+            from src.s3_transfer import S3Transfer
+            transfer = S3Transfer(s3_bucket_name)
+        self.transfer = transfer
         self.vision_client = vision.ImageAnnotatorClient()
         self.storage_client = storage.Client()
     
     def process_batch(self, s3_key, start_page, end_page):
         """Process single batch with Google Vision and return structured text"""
+        pages = self.extract_pages(s3_key, start_page, end_page)
+        if pages is None:
+            return None
         
-        # Upload PDF to GCS
-        gcs_input_path = f"{self.book_name}/input/{s3_key.split('/')[-1]}"
-        gcs_output_path = f"{self.book_name}/vision_output/"
-        
-        self._upload_s3_to_gcs(s3_key, gcs_input_path)
-        
-        # Run Vision OCR
-        gcs_source_uri = f"gs://{self.gcs_bucket_name}/{gcs_input_path}"
-        gcs_destination_uri = f"gs://{self.gcs_bucket_name}/{gcs_output_path}"
-        
-        operation = self._run_vision_ocr(gcs_source_uri, gcs_destination_uri)
+        text_key = processed_text_key(self.book_name, s3_key)
+        return save_processed_text(self.transfer, text_key, format_pages(pages))
+    
+    def extract_pages(self, s3_key, start_page, end_page):
+        """OCR a batch with Google Vision and return its pages, or None if OCR failed"""
+        batch_filename = s3_key.split('/')[-1].replace('.pdf', '')
         
-        if not operation:
-            return None
+        pdf_data = self.transfer.get(s3_key)
         
-        # Download and process results
-        structured_text = self._extract_vision_text(gcs_output_path, start_page, end_page)
+        # Skip OCR entirely if these exact pages were processed before
+        cache_key = None
+        if self.cache is not None:
+            version = f"{self.ENGINE_VERSION}-geometry" if self.keep_geometry else self.ENGINE_VERSION
+            cache_key = ocr_cache_key(pdf_data, self.ENGINE_NAME, version, start_page)
+            cached = load_cached_pages(self.cache, cache_key)
+            if cached is not None:
+                logger.info(f"OCR cache hit for {s3_key}")
+                return cached
         
-        # Save to S3
-        batch_filename = s3_key.split('/')[-1].replace('.pdf', '')
-        text_key = f"{self.book_name}/output/processed/{batch_filename}.txt"
+        # Unique per batch and per run, so listing only sees this request's shards
+        run_id = uuid.uuid4().hex[:8]
+        gcs_input_path = f"{self.book_name}/input/{batch_filename}-{run_id}.pdf"
+        gcs_output_path = f"{self.book_name}/vision_output/{batch_filename}-{run_id}/"
         
-        self.s3.put_object(
-            Bucket=self.s3_bucket_name,
-            Key=text_key,
-            Body=structured_text,
-            ContentType='text/plain'
-        )
+        # Upload PDF to GCS
+        self._upload_s3_to_gcs(s3_key, gcs_input_path, pdf_data)
         
-        logger.info(f"Saved processed text: {text_key}")
-        return text_key
+        output_blobs = None
+        try:
+            # Run Vision OCR
+            gcs_source_uri = f"gs://{self.gcs_bucket_name}/{gcs_input_path}"
+            gcs_destination_uri = f"gs://{self.gcs_bucket_name}/{gcs_output_path}"
+            
+            operation = self._run_vision_ocr(gcs_source_uri, gcs_destination_uri)
+            
+            if not operation:
+                return None
+            
+            # Download and process results
+            bucket = self.storage_client.bucket(self.gcs_bucket_name)
+            output_blobs = [blob for blob in bucket.list_blobs(prefix=gcs_output_path)
+                            if blob.name.endswith('.json')]
+            pages = self._extract_vision_pages(output_blobs, start_page, end_page)
+        finally:
+            self._cleanup_gcs(gcs_input_path, gcs_output_path, output_blobs)
+        
+        if cache_key and pages:
+            store_cached_pages(self.cache, cache_key, pages)
+        
+        return pages
     
-    def _upload_s3_to_gcs(self, s3_key, gcs_path):
+    def _upload_s3_to_gcs(self, s3_key, gcs_path, pdf_data=None):
         """Transfer PDF from S3 to GCS"""
-        # Download from S3
-        response = self.s3.get_object(Bucket=self.s3_bucket_name, Key=s3_key)
-        pdf_data = response['Body'].read()
+        # Download from S3 unless the caller already has the bytes
+        if pdf_data is None:
+            pdf_data = self.transfer.get(s3_key)
         
         # Upload to GCS
         bucket = self.storage_client.bucket(self.gcs_bucket_name)
@@ -86,33 +139,85 @@ class GoogleVisionProcessor:
             logger.error(f"Vision OCR failed: {e}")
             return False
     
-    def _extract_vision_text(self, gcs_output_path, start_page, end_page):
-        """Extract structured text from Vision results"""
-        bucket = self.storage_client.bucket(self.gcs_bucket_name)
-        
-        # List output files
-        blobs = list(bucket.list_blobs(prefix=gcs_output_path))
-        json_blobs = [blob for blob in blobs if blob.name.endswith('.json')]
-        
+    def _extract_vision_pages(self, json_blobs, start_page, end_page):
+        """Extract per-page text and confidence from all Vision output shards"""
         if not json_blobs:
-            return ""
-        
-        # Process first output file
-        blob = json_blobs[0]
-        json_string = blob.download_as_text()
-        data = json.loads(json_string)
-        
-        # Extract text from each page
-        result = []
-        for i, response in enumerate(data.get('responses', [])):
-            page_num = start_page + i
-            if page_num > end_page:
-                break
+            return []
+        
+        # Shards are independent; fetch and parse them in parallel
+        with ThreadPoolExecutor(max_workers=min(len(json_blobs), 8)) as pool:
+            shards = list(pool.map(self._parse_shard, json_blobs))
+        
+        pages = {}
+        for shard in shards:
+            for page_index, response in shard:
+                page_num = start_page + page_index - 1
+                if page_num > end_page:
+                    continue
                 
-            result.append(f"\n--- PAGE {page_num} ---\n")
-            
-            if 'fullTextAnnotation' in response:
-                text = response['fullTextAnnotation'].get('text', '')
-                result.append(text)
+                annotation = response.get('fullTextAnnotation', {})
+                confidence = mean_confidence(p.get('confidence') for p in annotation.get('pages', []))
+                lines, boxes = None, None
+                if self.keep_geometry:
+                    lines, boxes = self._vision_lines(annotation.get('pages', []))
+                pages[page_num] = make_page(page_num, annotation.get('text', ''), confidence, lines, boxes)
+        
+        return [pages[page_num] for page_num in sorted(pages)]
+    
+    def _vision_lines(self, annotation_pages):
+        """Rebuild lines and their normalized boxes from Vision's word symbols"""
+        lines = []
+        boxes = array('f')
+        for annotation_page in annotation_pages:
+            for block in annotation_page.get('blocks', []):
+                for paragraph in block.get('paragraphs', []):
+                    text, points = [], []
+                    for word in paragraph.get('words', []):
+                        detected = None
+                        for symbol in word.get('symbols', []):
+                            text.append(symbol.get('text', ''))
+                            detected = symbol.get('property', {}).get('detectedBreak', {}).get('type')
+                            if detected in ('SPACE', 'SURE_SPACE'):
+                                text.append(' ')
+                            elif detected == 'HYPHEN':
+                                text.append('-')
+                        points.extend(word.get('boundingBox', {}).get('normalizedVertices', []))
+                        
+                        if detected in LINE_BREAKS and points:
+                            self._add_line(lines, boxes, text, points)
+                            text, points = [], []
+                    if points:
+                        self._add_line(lines, boxes, text, points)
+        return lines, boxes
+    
+    def _add_line(self, lines, boxes, text, points):
+        # Vision omits coordinates that are 0
+        xs = [point.get('x', 0) for point in points]
+        ys = [point.get('y', 0) for point in points]
+        lines.append(''.join(text).strip())
+        boxes.extend((min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys)))
+    
+    def _parse_shard(self, blob):
+        """Download one output shard; returns (1-based page in batch PDF, response) pairs"""
+        data = json.loads(blob.download_as_text())
         
-        return '\n'.join(result)
\ No newline at end of file
+        match = SHARD_NAME.search(blob.name)
+        first_page = int(match.group(1)) if match else 1
+        
+        return [
+            (response.get('context', {}).get('pageNumber', first_page + i), response)
+            for i, response in enumerate(data.get('responses', []))
+        ]
+    
+    def _cleanup_gcs(self, gcs_input_path, gcs_output_path, output_blobs=None):
+        """Delete the batch's GCS input and output shards"""
+        bucket = self.storage_client.bucket(self.gcs_bucket_name)
+        try:
+            bucket.blob(gcs_input_path).delete()
+            # Failed requests may still have written some shards
+            if output_blobs is None:
+                output_blobs = list(bucket.list_blobs(prefix=gcs_output_path))
+            for blob in output_blobs:
+                blob.delete()
+        except Exception as e:
+            logger.warning(f"GCS cleanup failed for {gcs_input_path}: {e}")
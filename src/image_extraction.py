@@ -0,0 +1,148 @@
+#image_extraction.py
+import io
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def dhash(image, size=8):
+    """64-bit difference hash: compares neighbouring pixels of a small grayscale copy"""
+    from PIL import Image
+    small = image.convert('L').resize((size + 1, size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def is_blank(image, min_stddev=6.0):
+    """Nearly uniform images: empty plates, tissue guards, white boxes"""
+    from PIL import ImageStat
+    return ImageStat.Stat(image.convert('L')).stddev[0] < min_stddev
+
+
+class LocalImageExtractor:
+    """
+    Pulls embedded images straight out of a PDF with pdfium and uploads them
+    as page_{n}_image_{k}.jpg, the names link_images_to_content expects.
+
+    Images covering most of a page are taken to be the page scan itself and
+    skipped; blank images and near-duplicates of an image already kept
+    (repeated ornaments, printer's devices) are dropped.
+
+    Only images embedded as objects of their own are found: an illustration
+    printed inside a page scan is not cropped out. scanned_share() tells how
+    much of a book is page scans, so callers can send such books elsewhere.
+    """
+
+    def __init__(self, transfer, book_name, min_size=64, max_page_coverage=0.9,
+                 hash_distance=4, jpeg_quality=90):
+        """
+        Args:
+            transfer: src.s3_transfer.S3Transfer for the book's bucket
+            min_size: Images narrower or shorter than this many pixels are skipped
+            max_page_coverage: Images covering more of the page than this are page scans
+            hash_distance: Max dhash bit difference for two images to count as duplicates
+        """
+        self.transfer = transfer
+        self.book_name = book_name
+        self.min_size = min_size
+        self.max_page_coverage = max_page_coverage
+        self.hash_distance = hash_distance
+        self.jpeg_quality = jpeg_quality
+        self.skipped = {"small": 0, "page_scan": 0, "blank": 0, "duplicate": 0, "unreadable": 0}
+
+    def _is_page_scan(self, obj, page_width, page_height):
+        # get_bounds in pypdfium2 5, get_pos before
+        bounds = obj.get_bounds() if hasattr(obj, 'get_bounds') else obj.get_pos()
+        left, bottom, right, top = bounds
+        coverage = ((right - left) * (top - bottom)) / (page_width * page_height)
+        return coverage > self.max_page_coverage
+
+    def scanned_share(self, pdf_path):
+        """Share of pages that carry a page scan, read from image positions only"""
+        import pypdfium2
+        import pypdfium2.raw as pdfium_c
+
+        pdf = pypdfium2.PdfDocument(str(pdf_path))
+        try:
+            scanned = 0
+            for page_index in range(len(pdf)):
+                page = pdf[page_index]
+                page_width, page_height = page.get_size()
+                scanned += any(
+                    self._is_page_scan(obj, page_width, page_height)
+                    for obj in page.get_objects(filter=(pdfium_c.FPDF_PAGEOBJ_IMAGE,))
+                )
+                page.close()
+            return scanned / len(pdf) if len(pdf) else 0.0
+        finally:
+            pdf.close()
+
+    def extract(self, pdf_path):
+        """Extract, dedup and upload every image; returns the number uploaded"""
+        import pypdfium2
+        import pypdfium2.raw as pdfium_c
+
+        kept_hashes = []
+        uploaded = 0
+        started = time.monotonic()
+        pdf = pypdfium2.PdfDocument(str(pdf_path))
+        try:
+            for page_index in range(len(pdf)):
+                page = pdf[page_index]
+                page_width, page_height = page.get_size()
+                uploads = []
+                for obj in page.get_objects(filter=(pdfium_c.FPDF_PAGEOBJ_IMAGE,)):
+                    if self._is_page_scan(obj, page_width, page_height):
+                        self.skipped["page_scan"] += 1
+                        continue
+
+                    try:
+                        image = obj.get_bitmap(render=False).to_pil()
+                    except Exception as e:
+                        logger.warning(f"Could not read an image on page {page_index + 1}: {e}")
+                        self.skipped["unreadable"] += 1
+                        continue
+
+                    if min(image.size) < self.min_size:
+                        self.skipped["small"] += 1
+                        continue
+                    if is_blank(image):
+                        self.skipped["blank"] += 1
+                        continue
+
+                    image_hash = dhash(image)
+                    if any(hamming(image_hash, kept) <= self.hash_distance for kept in kept_hashes):
+                        self.skipped["duplicate"] += 1
+                        continue
+                    kept_hashes.append(image_hash)
+
+                    uploads.append(self._encode(image, page_index + 1, len(uploads) + 1))
+                page.close()
+
+                # A page's images are uploaded together
+                self.transfer.put_many(uploads)
+                uploaded += len(uploads)
+        finally:
+            pdf.close()
+
+        logger.info(f"Extracted {uploaded} images locally in {time.monotonic() - started:.1f}s, "
+                    f"skipped {self.skipped}")
+        return uploaded
+
+    def _encode(self, image, page_number, image_number):
+        """(key, JPEG bytes, content type) for put_many"""
+        buffer = io.BytesIO()
+        image.convert('RGB').save(buffer, format='JPEG', quality=self.jpeg_quality)
+        s3_key = f"{self.book_name}/output/images/page_{page_number}_image_{image_number}.jpg"
+        return s3_key, buffer.getvalue(), "image/jpeg"
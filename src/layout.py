@@ -0,0 +1,258 @@
+#layout.py
+"""
+Layout analysis of OCR pages that carry line geometry (see src.ocr_pages).
+
+Running headers, footers and page numbers are recognised from their position
+and dropped from the text, marginal notes and footnotes are tagged, and the
+body is put in column-aware reading order. All coordinates are normalized to
+0-1 with the origin at the top left of the page.
+"""
+import re
+import logging
+from statistics import median
+from src.ocr_pages import page_line_boxes
+from src.text_cleanup import parse_page_number
+
+logger = logging.getLogger(__name__)
+
+# "12 MISSION TO ASHANTEE" / "MISSION TO ASHANTEE 13"
+NUMBERED_HEADER = re.compile(r'^(\d{1,4}\s+\S.*|.*\S\s+\d{1,4})$')
+HEADING = re.compile(r'^(chapter|book|part|section)\b', re.IGNORECASE)
+FOOTNOTE_MARKER = re.compile(r'^([*†‡§|¶]|\d{1,2}[.)]?\s)')
+# Without a page sequence to check against, "mix." (1009) must not pass as a prelim page
+MAX_ROMAN_PAGE = 100
+# Longer numbered lines in the footer band are footnotes or text, not running footers
+MAX_FOOTER_CHARS = 40
+
+# Tags the LLM prompts know about
+FOOTNOTE_TAG = "[FOOTNOTE]"
+MARGINALIA_TAG = "[MARGINALIA]"
+
+
+class _Line:
+    __slots__ = ("text", "left", "top", "width", "height")
+
+    def __init__(self, text, left, top, width, height):
+        self.text = text
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+
+    @property
+    def right(self):
+        return self.left + self.width
+
+    @property
+    def bottom(self):
+        return self.top + self.height
+
+    @property
+    def middle(self):
+        return self.top + self.height / 2
+
+
+def analyze_page(page, header_band=0.08, footer_band=0.92):
+    """
+    Return a copy of the page with layout-ordered, tagged text and a "regions"
+    dict of the lines found in each region. Pages without geometry are
+    returned unchanged.
+
+    Args:
+        header_band: Lines centred above this are header candidates
+        footer_band: Lines centred below this are footer candidates
+    """
+    if page.get("boxes") is None:
+        return page
+
+    lines = [_Line(*line) for line in page_line_boxes(page) if line[0].strip()]
+    if not lines:
+        return page
+
+    regions = {"header": [], "footer": [], "page_number": [], "marginalia": [], "footnote": []}
+    body = []
+    for line in lines:
+        kind = _margin_kind(line, header_band, footer_band)
+        if kind:
+            regions[kind].append(line)
+        else:
+            body.append(line)
+
+    line_height = median(line.height for line in body) if body else 0
+    body, regions["marginalia"] = _split_marginalia(body)
+    body, regions["footnote"] = _split_footnotes(body, line_height)
+
+    parts = []
+    if body:
+        parts.append(_join_lines(_reading_order(body), line_height))
+    parts.extend(f"{MARGINALIA_TAG} {note}" for note in _group_notes(regions["marginalia"], line_height))
+    parts.extend(f"{FOOTNOTE_TAG} {note}" for note in _group_footnotes(regions["footnote"]))
+
+    # Keep figure placeholders an engine appended to the flat text
+    parts.extend(line for line in page["text"].split('\n') if line.startswith("[FIGURE_PLACEHOLDER_"))
+
+    return dict(
+        page,
+        text='\n\n'.join(parts),
+        regions={kind: [line.text for line in found] for kind, found in regions.items()}
+    )
+
+
+def _margin_kind(line, header_band, footer_band):
+    """
+    'header', 'footer' or 'page_number' for lines in the top/bottom bands that
+    look like running text. Anything else stays in the body, where footnotes
+    and last lines of tightly trimmed scans are found.
+    """
+    text = line.text.strip()
+    if line.middle < header_band:
+        if _is_page_number(text):
+            return "page_number"
+        if HEADING.match(text):
+            return None
+        if NUMBERED_HEADER.match(text) or text.isupper():
+            return "header"
+    elif line.middle > footer_band:
+        if _is_page_number(text):
+            return "page_number"
+        if FOOTNOTE_MARKER.match(text):
+            return None
+        if text.isupper() or (NUMBERED_HEADER.match(text) and len(text) <= MAX_FOOTER_CHARS):
+            return "footer"
+    return None
+
+
+def _is_page_number(text):
+    number = parse_page_number(text.lower())
+    return number is not None and (number[0] == 'arabic' or number[1] <= MAX_ROMAN_PAGE)
+
+
+def _split_marginalia(body):
+    """Separate narrow lines that sit outside the main text block"""
+    wide = [line for line in body if line.width > 0.3]
+    if len(wide) < 3:
+        return body, []
+
+    text_left = median(line.left for line in wide)
+    text_right = median(line.right for line in wide)
+    margin = (text_right - text_left) * 0.05
+
+    kept, notes = [], []
+    for line in body:
+        outside = line.right < text_left + margin or line.left > text_right - margin
+        if outside and line.width < 0.2:
+            notes.append(line)
+        else:
+            kept.append(line)
+    return kept, notes
+
+
+def _split_footnotes(body, line_height):
+    """
+    Footnotes are the run of smaller lines at the bottom of the body that
+    starts with a footnote marker.
+    """
+    if len(body) < 3 or not line_height:
+        return body, []
+
+    ordered = sorted(body, key=lambda line: line.top)
+    start = len(ordered)
+    while start > 0:
+        line = ordered[start - 1]
+        if line.height >= line_height * 0.85 or line.top < 0.5:
+            break
+        start -= 1
+
+    # Walk down to the first marker so a short last body line is not taken
+    while start < len(ordered) and not FOOTNOTE_MARKER.match(ordered[start].text):
+        start += 1
+    if start == len(ordered):
+        return body, []
+    return ordered[:start], ordered[start:]
+
+
+def _column_gap(lines):
+    """x position of an empty vertical gutter in the middle of the page, if any"""
+    # Full-width lines (titles, single-column stretches) may cross the gutter
+    narrow = [line for line in lines if line.width < 0.5]
+    if len(narrow) < 6:
+        return None
+
+    bins = 100
+    coverage = [0] * bins
+    for line in narrow:
+        for b in range(max(0, int(line.left * bins)), min(bins, int(line.right * bins) + 1)):
+            coverage[b] += 1
+
+    gutter = [b for b in range(30, 71) if coverage[b] == 0]
+    if not gutter:
+        return None
+
+    gap = (gutter[0] + gutter[-1]) / 2 / bins
+    left = sum(1 for line in narrow if line.right <= gap)
+    right = sum(1 for line in narrow if line.left >= gap)
+    if left < 3 or right < 3:
+        return None
+    return gap
+
+
+def _reading_order(lines):
+    """
+    Top to bottom, except that two-column stretches are read left column then
+    right column; lines crossing the gutter end a stretch.
+    """
+    ordered = sorted(lines, key=lambda line: (line.top, line.left))
+    gap = _column_gap(ordered)
+    if gap is None:
+        return ordered
+
+    result, left, right = [], [], []
+    for line in ordered:
+        if line.right <= gap:
+            left.append(line)
+        elif line.left >= gap:
+            right.append(line)
+        else:
+            result.extend(left + right)
+            left, right = [], []
+            result.append(line)
+    result.extend(left + right)
+    return result
+
+
+def _join_lines(lines, line_height):
+    """Join lines, with a blank line where the vertical gap suggests a new paragraph"""
+    text = []
+    previous = None
+    for line in lines:
+        if previous is not None:
+            gap = line.top - previous.bottom
+            new_block = gap > line_height * 0.8 or gap < -line_height
+            text.append('\n\n' if new_block else '\n')
+        text.append(line.text)
+        previous = line
+    return ''.join(text)
+
+
+def _group_notes(lines, line_height):
+    """Join marginal lines into notes, starting a new note at a vertical gap"""
+    notes = []
+    previous = None
+    for line in sorted(lines, key=lambda line: line.top):
+        if previous is not None and line.top - previous.bottom <= line_height:
+            notes[-1] += ' ' + line.text
+        else:
+            notes.append(line.text)
+        previous = line
+    return notes
+
+
+def _group_footnotes(lines):
+    """Join footnote lines, starting a new footnote at each marker"""
+    notes = []
+    for line in lines:
+        if FOOTNOTE_MARKER.match(line.text) or not notes:
+            notes.append(line.text)
+        else:
+            notes[-1] += ' ' + line.text
+    return notes
@@ -1,28 +1,163 @@
-import boto3
 import json
 import logging
 import re
+import threading
+from collections import Counter
+from functools import lru_cache
 from pathlib import Path
+from src.bedrock_client import BedrockInvocationError, get_invoker
+from src.cache import llm_cache_key
+from src.ocr_pages import format_pages, split_pages
+from src.page_classifier import LLM, classify_page, local_page
 
 logger = logging.getLogger(__name__)
 
+# Rough size of a "## PAGE n" section's markup in output tokens
+PAGE_OVERHEAD_TOKENS = 20
+
+PROMPT_DIR = Path(__file__).parent / "prompts"
+TEMPLATE_VARIABLE = re.compile(r'\{\{(\w+)\}\}')
+
+
+class PromptTemplate:
+    """
+    A prompt file split once into literal text and {{VARIABLE}} slots.
+    
+    Templates keep their instructions before the first variable, so that
+    static_prefix is identical for every batch and can be cached by Bedrock.
+    """
+    
+    def __init__(self, text):
+        parts = TEMPLATE_VARIABLE.split(text)
+        self.text = text
+        self.literals = parts[0::2]
+        self.variables = parts[1::2]
+    
+    @property
+    def static_prefix(self):
+        return self.literals[0]
+    
+    def render_suffix(self, **values):
+        """Everything after the static prefix, with variables filled in one pass"""
+        out = []
+        for variable, literal in zip(self.variables, self.literals[1:]):
+            out.append(str(values[variable]) if variable in values else f"{{{{{variable}}}}}")
+            out.append(literal)
+        return ''.join(out)
+    
+    def render(self, **values):
+        return self.static_prefix + self.render_suffix(**values)
+
+
+@lru_cache(maxsize=None)
+def load_template(name):
+    """Read and compile a prompt template once per process"""
+    with open(PROMPT_DIR / name, 'r') as f:
+        return PromptTemplate(f.read())
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (about 4 characters per token for English prose)"""
+    return len(text) // 4 + 1
+
+
+def pack_pages(pages, output_budget, output_ratio=1.2):
+    """
+    Group consecutive OCR pages into requests whose estimated output stays
+    within output_budget tokens. A page over the budget gets a request of its own.
+    """
+    groups = []
+    current, current_tokens = [], 0
+    for page in pages:
+        tokens = int(estimate_tokens(page['text']) * output_ratio) + PAGE_OVERHEAD_TOKENS
+        if current and current_tokens + tokens > output_budget:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(page)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+class PageStreamParser:
+    """
+    Splits streamed markdown into "## PAGE n" sections, passing each one to
+    on_section(page_num, content) as soon as the next section starts.
+    """
+    HEADER = re.compile(r'## PAGE (\d+)\n')
+    
+    def __init__(self, on_section):
+        self.on_section = on_section
+        self.buffer = ""
+        self.current = None  # (page_num, offset where its content starts)
+        self.scan_from = 0
+    
+    @property
+    def prefix(self):
+        """Text before the first page, where the TOC mapping is"""
+        return self.buffer[:self.current[1]] if self.current else self.buffer
+    
+    def feed(self, text):
+        self.buffer += text
+        for match in self.HEADER.finditer(self.buffer, self.scan_from):
+            if self.current:
+                self.on_section(self.current[0], self.buffer[self.current[1]:match.start()])
+            self.current = (match.group(1), match.end())
+            self.scan_from = match.end()
+        # A header split across pieces is matched once the rest arrives
+        self.scan_from = max(self.scan_from, len(self.buffer) - 16)
+    
+    def close(self, complete=True):
+        """End of stream; the last section only counts if the response finished"""
+        if self.current and complete:
+            self.on_section(self.current[0], self.buffer[self.current[1]:])
+        self.current = None
+
+
 class LLMParser:
-    def __init__(self):
-        self.bedrock = boto3.client(
-            'bedrock-runtime', 
-            region_name='us-east-1',
-            config=boto3.session.Config(
-                read_timeout=600,
-                connect_timeout=60,
-                retries={'max_attempts': 3}
-            )
-        )
+    def __init__(self, cache=None, model_id='anthropic.claude-3-sonnet-20240229-v1:0', temperature=0,
+                 max_tokens=8000, token_budget=6000, skip_trivial=True, invoker=None,
+                 stream=False, page_listener=None, prompt_caching=False):
+        """
+        Args:
+            cache: Optional response cache (see src.cache), keyed by model id,
+                temperature and the rendered prompt
+            max_tokens: Output token limit of a Bedrock request
+            token_budget: Estimated output tokens to pack into one request,
+                leaving headroom below max_tokens for estimation error
+            skip_trivial: Build blank, image-only and plain prose pages locally
+                (see src.page_classifier) instead of sending them to Bedrock
+            invoker: BedrockInvoker to call through; defaults to the shared
+                one for us-east-1 (see src.bedrock_client)
+            stream: Stream responses; pages reach page_listener as each one
+                closes, and a stream that breaks off keeps its finished pages
+            page_listener: Optional callable given each final page record as
+                soon as it is known, possibly from several threads and out of
+                page order. Changes it makes to the record are kept. Chapters
+                may still be None in two_phase mode.
+            prompt_caching: Mark the static instructions of each prompt for
+                Bedrock prompt caching; the model must support it
+        """
+        self.cache = cache
+        self.model_id = model_id
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.token_budget = token_budget
+        self.skip_trivial = skip_trivial
+        self.requests = 0
+        self.retried_pages = 0
+        self.skipped_pages = Counter()
+        self._stats_lock = threading.Lock()
+        self.invoker = invoker or get_invoker('us-east-1')
+        self.stream = stream
+        self.page_listener = page_listener
+        self.prompt_caching = prompt_caching
+        self.usage = Counter()
     
-    def load_prompt(self, prompt_file: str) -> str: #TODO PROMPT FILE?
-        """Load prompt from file"""
-        prompt_path = Path("src/prompts") / prompt_file.split('/')[-1]
-        with open(prompt_path, 'r') as f:
-            return f.read()
+    def load_prompt(self, prompt_file: str) -> str:
+        """Load prompt from file (read once per process)"""
+        return load_template(prompt_file.split('/')[-1]).text
 
     
     def replace_template_vars(self, prompt: str, **kwargs) -> str:
@@ -33,65 +168,122 @@ class LLMParser:
     
 
     def call_bedrock_markdown(self, prompt: str):
-        try:
-            response = self.bedrock.invoke_model(
-                modelId='anthropic.claude-3-sonnet-20240229-v1:0',
-                body=json.dumps({
-                    "anthropic_version": "bedrock-2023-05-31",
-                    "messages": [{"role": "user", "content": prompt}],
-                    "max_tokens": 8000,
-                    "temperature": 0
-                }),
-                contentType='text/plain',
-                accept='application/json'
-            )
-                
-            result = json.loads(response['body'].read())
-            content = result['content'][0]['text']
-            return content
-                
-        except Exception as e:
-            logger.error(f"Bedrock call failed: {e}")
-            return ""
-    
-    def parse_markdown_response(self, markdown_content: str, toc_mapping: dict = None, current_chapter: str = None):
-        """Parse markdown response into structured data"""
-        result = {"pages": [], "toc_extracted": {}}
+        return self._invoke(prompt)[0]
+    
+    def _invoke(self, prompt: str, stream_parser: PageStreamParser = None, static_prefix: str = ""):
+        """
+        Call Bedrock with static_prefix + prompt; returns (content, stop_reason).
+        Raises BedrockInvocationError once the invoker has given up, rather
+        than passing on an empty response.
+        
+        When streaming, content arrives through stream_parser as well, and a
+        stream that broke off returns what it got with stop_reason 'error'.
+        """
+        cache_key = None
+        if self.cache is not None:
+            cache_key = llm_cache_key(self.model_id, self.temperature, static_prefix + prompt)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                logger.info("LLM cache hit")
+                content = cached.decode('utf-8')
+                if stream_parser is not None:
+                    stream_parser.feed(content)
+                    stream_parser.close()
+                return content, None
+        
+        with self._stats_lock:
+            self.requests += 1
+        if static_prefix and self.prompt_caching:
+            message_content = [
+                {"type": "text", "text": static_prefix, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": prompt}
+            ]
+        else:
+            message_content = static_prefix + prompt
+        body = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "messages": [{"role": "user", "content": message_content}],
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature
+        }
+        if self.stream:
+            result = self.invoker.invoke_stream(self.model_id, body,
+                                                stream_parser.feed if stream_parser else lambda text: None)
+        else:
+            result = self.invoker.invoke(self.model_id, body)
+        
+        if not result.ok and not result.body:
+            raise BedrockInvocationError(f"Bedrock call failed after {result.attempts} attempts: {result.error}")
+        
+        content = result.body['content'][0]['text']
+        stop_reason = result.body.get('stop_reason') if result.ok else 'error'
+        with self._stats_lock:
+            self.usage.update({k: v for k, v in result.body.get('usage', {}).items() if isinstance(v, int)})
+        if stream_parser is not None:
+            stream_parser.close(complete=stop_reason not in ('max_tokens', 'error'))
+        
+        # Truncated responses are retried in smaller pieces, so don't keep them
+        if cache_key and content and stop_reason not in ('max_tokens', 'error'):
+            self.cache.put(cache_key, content.encode('utf-8'))
+        return content, stop_reason
+    
+    def cache_stats(self):
+        """Hit/miss counters of the response cache"""
+        if self.cache is None:
+            return {"hits": 0, "misses": 0}
+        return self.cache.stats()
+    
+    def parse_markdown_response(self, markdown_content: str, toc_mapping: dict = None, current_chapter: str = None,
+                                defer_carryover: bool = False):
+        """
+        Parse markdown response into structured data
+        
+        With defer_carryover, pages with no TOC entry or heading get chapter None
+        instead of current_chapter, to be filled in by a later reconciliation pass.
+        """
+        result = {"pages": [], "toc_extracted": self._extract_toc(markdown_content)}
+        
+        # Extract pages
+        page_pattern = r'## PAGE (\d+)\n(.*?)(?=## PAGE \d+|\Z)'
+        pages = re.findall(page_pattern, markdown_content, re.DOTALL)
+        
+        for page_num, content in pages:
+            result["pages"].append(self._page_record(page_num, content, result["toc_extracted"], toc_mapping,
+                                                     current_chapter, defer_carryover))
         
-        # Extract TOC mapping if present (first batch)
+        return result
+    
+    def _extract_toc(self, markdown_content):
+        """TOC mapping from the response, if present (first batch)"""
         if "## TOC_MAPPING" in markdown_content:
             toc_match = re.search(r'## TOC_MAPPING\n(.*?)\n\n', markdown_content, re.DOTALL)
             if toc_match:
                 try:
-                    result["toc_extracted"] = json.loads(toc_match.group(1))
+                    return json.loads(toc_match.group(1))
                 except:
                     logger.warning("Failed to parse TOC mapping")
+        return {}
+    
+    def _page_record(self, page_num, content, new_toc, toc_mapping, current_chapter, defer_carryover):
+        # Determine chapter
+        chapter = self._determine_chapter(page_num, content, new_toc, toc_mapping, current_chapter,
+                                          defer_carryover)
         
-        # Extract pages
-        page_pattern = r'## PAGE (\d+)\n(.*?)(?=## PAGE \d+|\Z)'
-        pages = re.findall(page_pattern, markdown_content, re.DOTALL)
+        # Check if it's a chapter start
+        chapter_start = self._is_chapter_start(content)
         
-        for page_num, content in pages:
-            # Determine chapter
-            chapter = self._determine_chapter(page_num, content, result.get("toc_extracted", {}), toc_mapping, current_chapter)
-            
-            # Check if it's a chapter start
-            chapter_start = self._is_chapter_start(content)
-            
-            # Check if it has images
-            has_images = "![" in content
-            
-            result["pages"].append({
-                "page_number": page_num,
-                "content": content.strip(),
-                "chapter": chapter,
-                "chapter_start": chapter_start,
-                "has_images": has_images
-            })
+        # Check if it has images
+        has_images = "![" in content
         
-        return result
+        return {
+            "page_number": page_num,
+            "content": content.strip(),
+            "chapter": chapter,
+            "chapter_start": chapter_start,
+            "has_images": has_images
+        }
     
-    def _determine_chapter(self, page_num, content, new_toc, existing_toc, current_chapter):
+    def _determine_chapter(self, page_num, content, new_toc, existing_toc, current_chapter, defer_carryover=False):
         """Determine chapter for a page"""
         # Check new TOC first
         if page_num in new_toc:
@@ -107,6 +299,10 @@ class LLMParser:
             title = chapter_match.group(1).lower()
             return re.sub(r'[^a-zA-Z0-9\-]', '-', title)
         
+        # Leave unresolved for reconciliation
+        if defer_carryover:
+            return None
+        
         # Default to current chapter or frontmatter
         return current_chapter or "frontmatter"
     
@@ -114,40 +310,191 @@ class LLMParser:
         """Check if page contains a chapter start"""
         return bool(re.search(r'^# ', content, re.MULTILINE))
     
-    def parse_first_batch(self, textract_output: str, start_page: int, 
-                         end_page: int, book_name: str):
-        """Parse first batch for TOC extraction"""
-        prompt = self.load_prompt("prompts/toc_prompt.txt")
-        
-        formatted_prompt = self.replace_template_vars(
-            prompt,
+    def _render_prompt(self, first_batch, textract_output, start_page, end_page, book_name,
+                       toc_mapping=None, current_chapter=None):
+        """The prompt as (static prefix, per-batch suffix)"""
+        if first_batch:
+            template = load_template("toc_prompt.txt")
+            values = {}
+        else:
+            template = load_template("subsequent_batch_prompt.txt")
+            values = {
+                "TOC_MAPPING": json.dumps(toc_mapping or {}),
+                "CURRENT_CHAPTER": current_chapter or ""
+            }
+        suffix = template.render_suffix(
             TEXTRACT_OUTPUT=textract_output,
             START_PAGE=start_page,
             END_PAGE=end_page,
-            BOOK_NAME=book_name
+            BOOK_NAME=book_name,
+            **values
         )
+        return template.static_prefix, suffix
+    
+    def parse_first_batch(self, textract_output: str, start_page: int, 
+                         end_page: int, book_name: str):
+        """Parse first batch for TOC extraction"""
+        static_prefix, formatted_prompt = self._render_prompt(True, textract_output, start_page, end_page,
+                                                              book_name)
         
         logger.info(f"Sending first batch prompt to Bedrock")
-        markdown_response = self.call_bedrock_markdown(formatted_prompt)
+        markdown_response = self._invoke(formatted_prompt, static_prefix=static_prefix)[0]
         return self.parse_markdown_response(markdown_response)
     
     def parse_subsequent_batch(self, textract_output: str, start_page: int,
                              end_page: int, book_name: str,
                              toc_mapping: dict = None,
-                             current_chapter: str = None):
+                             current_chapter: str = None,
+                             defer_carryover: bool = False):
         """Parse subsequent batch with context"""
-        prompt = self.load_prompt("prompts/subsequent_batch_prompt.txt")
-        
-        formatted_prompt = self.replace_template_vars(
-            prompt,
-            TEXTRACT_OUTPUT=textract_output,
-            START_PAGE=start_page,
-            END_PAGE=end_page,
-            BOOK_NAME=book_name,
-            TOC_MAPPING=json.dumps(toc_mapping or {}),
-            CURRENT_CHAPTER=current_chapter or ""
-        )
+        static_prefix, formatted_prompt = self._render_prompt(False, textract_output, start_page, end_page,
+                                                              book_name, toc_mapping, current_chapter)
         
         logger.info(f"Sending subsequent batch prompt to Bedrock")
-        markdown_response = self.call_bedrock_markdown(formatted_prompt)
-        return self.parse_markdown_response(markdown_response, toc_mapping, current_chapter)
\ No newline at end of file
+        markdown_response = self._invoke(formatted_prompt, static_prefix=static_prefix)[0]
+        return self.parse_markdown_response(markdown_response, toc_mapping, current_chapter, defer_carryover)
+    
+    def parse_batch(self, textract_output: str, start_page: int, end_page: int, book_name: str,
+                    first_batch: bool = False, toc_mapping: dict = None, current_chapter: str = None,
+                    defer_carryover: bool = False):
+        """
+        Parse an OCR batch in as many Bedrock requests as the token budget needs.
+        
+        Pages are packed into requests by estimated output size; a response
+        that is cut off is kept up to its last complete page and the rest is
+        requested again in pieces about the size of what fit.
+        """
+        pages = split_pages(textract_output)
+        if not pages:
+            if first_batch:
+                return self.parse_first_batch(textract_output, start_page, end_page, book_name)
+            return self.parse_subsequent_batch(textract_output, start_page, end_page, book_name,
+                                               toc_mapping, current_chapter, defer_carryover)
+        
+        result = {"pages": [], "toc_extracted": {}}
+        toc_mapping = dict(toc_mapping or {})
+        batch_chapter = current_chapter
+        
+        # Pages that need no restructuring never reach the LLM
+        local = {}
+        llm_pages = []
+        for page in pages:
+            kind = classify_page(page['text']) if self.skip_trivial else LLM
+            if kind != LLM and str(page['page_number']) not in toc_mapping:
+                local[page['page_number']] = kind
+            else:
+                llm_pages.append(page)
+        if local:
+            with self._stats_lock:
+                self.skipped_pages.update(local.values())
+            logger.info(f"Pages {start_page}-{end_page}: {len(local)} of {len(pages)} built without the LLM")
+        
+        groups = pack_pages(llm_pages, self.token_budget)
+        if len(groups) > 1:
+            logger.info(f"Pages {start_page}-{end_page} packed into {len(groups)} LLM requests")
+        
+        for group in groups:
+            parsed = self._parse_pages(group, book_name, first_batch and not result["pages"],
+                                       toc_mapping, current_chapter, defer_carryover)
+            result["pages"].extend(parsed["pages"])
+            result["toc_extracted"].update(parsed["toc_extracted"])
+            toc_mapping.update(parsed["toc_extracted"])
+            if parsed["pages"] and parsed["pages"][-1]["chapter"] is not None:
+                current_chapter = parsed["pages"][-1]["chapter"]
+        
+        if local:
+            result["pages"] = self._merge_local_pages(result["pages"], pages, local, batch_chapter,
+                                                      defer_carryover)
+        return result
+    
+    def _merge_local_pages(self, llm_pages, pages, local, current_chapter, defer_carryover):
+        """Put locally built pages between the LLM's, continuing the chapter before them"""
+        texts = {page['page_number']: page['text'] for page in pages}
+        by_number = {int(page['page_number']): page for page in llm_pages}
+        merged = []
+        for page_number in sorted(set(by_number) | set(local)):
+            if page_number in local:
+                chapter = None if defer_carryover else current_chapter or "frontmatter"
+                merged.append(local_page(page_number, texts[page_number], local[page_number], chapter))
+                self._emit(merged[-1:])
+            else:
+                merged.append(by_number[page_number])
+                current_chapter = by_number[page_number]["chapter"] or current_chapter
+        return merged
+    
+    def _parse_pages(self, pages, book_name, first_batch, toc_mapping, current_chapter, defer_carryover):
+        """One request for the given pages, retrying whatever a truncated response left out"""
+        start_page, end_page = pages[0]['page_number'], pages[-1]['page_number']
+        static_prefix, prompt = self._render_prompt(first_batch, format_pages(pages), start_page, end_page,
+                                                    book_name, toc_mapping, current_chapter)
+        # Streamed pages go to the listener as they close
+        emitted = {}
+        stream_parser = None
+        if self.stream and self.page_listener:
+            def on_section(page_num, content):
+                new_toc = self._extract_toc(stream_parser.prefix)
+                emitted[page_num] = self._page_record(page_num, content, new_toc, toc_mapping,
+                                                      current_chapter, defer_carryover)
+                self.page_listener(emitted[page_num])
+            stream_parser = PageStreamParser(on_section)
+        
+        content, stop_reason = self._invoke(prompt, stream_parser, static_prefix)
+        parsed = self.parse_markdown_response(content, toc_mapping, current_chapter, defer_carryover)
+        # Keep the records the listener saw, so anything it did to them sticks
+        parsed["pages"] = [emitted.get(page["page_number"], page) for page in parsed["pages"]]
+        
+        # The last page of a response that was cut off is probably incomplete
+        returned = [page for page in parsed["pages"] if start_page <= int(page["page_number"]) <= end_page]
+        if stop_reason in ('max_tokens', 'error') and returned:
+            returned.pop()
+        last_returned = int(returned[-1]["page_number"]) if returned else start_page - 1
+        self._emit([page for page in returned if page["page_number"] not in emitted])
+        
+        # Pages missing after the last one returned were lost to truncation
+        remaining = [page for page in pages if page['page_number'] > last_returned]
+        if not remaining or (len(pages) == 1 and not returned):
+            if remaining:
+                logger.warning(f"LLM returned nothing usable for page {start_page}")
+                self._emit([page for page in parsed["pages"] if page["page_number"] not in emitted])
+            return parsed
+        
+        logger.warning(f"LLM response for pages {start_page}-{end_page} stopped after page "
+                       f"{last_returned} (stop_reason={stop_reason}), retrying the rest")
+        with self._stats_lock:
+            self.retried_pages += len(remaining)
+        parsed["pages"] = returned
+        if returned and returned[-1]["chapter"] is not None:
+            current_chapter = returned[-1]["chapter"]
+        
+        # Re-request in pieces about the size of what fit this time
+        size = len(returned) + 1 if returned else max(1, len(pages) // 2)
+        parts = [remaining[i:i + size] for i in range(0, len(remaining), size)]
+        
+        for part in parts:
+            toc_mapping = dict(toc_mapping or {}, **parsed["toc_extracted"])
+            retried = self._parse_pages(part, book_name, first_batch and not parsed["pages"],
+                                        toc_mapping, current_chapter, defer_carryover)
+            parsed["pages"].extend(retried["pages"])
+            parsed["toc_extracted"].update(retried["toc_extracted"])
+            if retried["pages"] and retried["pages"][-1]["chapter"] is not None:
+                current_chapter = retried["pages"][-1]["chapter"]
+        return parsed
+    
+    def _emit(self, page_records):
+        if self.page_listener:
+            for record in page_records:
+                self.page_listener(record)
+    
+    def stats(self):
+        """
+        Bedrock requests made, pages re-requested after truncation, pages
+        skipped by kind and token usage (including prompt cache reads/writes)
+        """
+        with self._stats_lock:
+            return {
+                "requests": self.requests,
+                "retried_pages": self.retried_pages,
+                "skipped_pages": dict(self.skipped_pages),
+                "usage": dict(self.usage),
+                "bedrock": self.invoker.stats()
+            }
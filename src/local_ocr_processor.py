@@ -0,0 +1,176 @@
+#local_ocr_processor.py
+import io
+import os
+import time
+import tempfile
+import threading
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PyPDF2 import PdfReader
+from src.cache import ocr_cache_key
+from src.ocr_pages import (
+    make_page, mean_confidence, format_pages, processed_text_key, save_processed_text,
+    load_cached_pages, store_cached_pages
+)
+
+logger = logging.getLogger(__name__)
+
+# Batch PDFs open in a worker process, by path, so page tasks only carry an index
+_worker_pdfs = {}
+# Concurrent batches interleave their pages; keep this many open per process
+WORKER_OPEN_PDFS = 8
+
+
+def _worker_pdf(pdf_path):
+    pdf = _worker_pdfs.get(pdf_path)
+    if pdf is None:
+        import pypdfium2
+        while len(_worker_pdfs) >= WORKER_OPEN_PDFS:
+            _worker_pdfs.pop(next(iter(_worker_pdfs))).close()
+        pdf = _worker_pdfs[pdf_path] = pypdfium2.PdfDocument(pdf_path)
+    return pdf
+
+
+def _ocr_page(pdf_path, page_index, dpi, lang):
+    """Rasterize one page of a batch PDF and OCR it; returns (text, confidence)"""
+    import pytesseract
+    page = _worker_pdf(pdf_path)[page_index]
+    image = page.render(scale=dpi / 72, grayscale=True).to_pil()
+    data = pytesseract.image_to_data(image, lang=lang, output_type=pytesseract.Output.DICT)
+
+    # Rebuild lines from words, with a blank line between paragraphs
+    lines = []
+    confidences = []
+    current_line = None
+    current_par = None
+    for i, word in enumerate(data['text']):
+        if not word.strip():
+            continue
+        par = (data['block_num'][i], data['par_num'][i])
+        line = par + (data['line_num'][i],)
+        if line != current_line:
+            if current_par is not None and par != current_par:
+                lines.append([])
+            lines.append([])
+            current_line, current_par = line, par
+        lines[-1].append(word)
+
+        confidence = float(data['conf'][i])
+        if confidence >= 0:
+            confidences.append(confidence / 100)
+
+    text = '\n'.join(' '.join(words) for words in lines)
+    return text, mean_confidence(confidences)
+
+
+class LocalOCRProcessor:
+    """
+    OCR on the local CPU: pages are rasterized with pdfium and read by
+    Tesseract across a process pool. Same contract and output format as
+    GoogleVisionProcessor/TextractProcessor, without an OCR service.
+
+    One pool serves every batch, whichever OCR thread it comes from, so the
+    process count stays at `workers`. Its processes are started by a fork
+    server rather than forked from this process, whose boto3 and transfer
+    threads may hold locks at fork time.
+    """
+    ENGINE_NAME = "tesseract"
+    # Bump when the text extraction changes
+    ENGINE_VERSION = "2"
+
+    def __init__(self, bucket_name, book_name, cache=None, workers=None, dpi=300, lang="eng",
+                 transfer=None):
+        """
+        Args:
+            cache: Optional OCR result cache (see src.cache)
+            workers: Number of OCR processes shared by all batches, defaults to the CPU count
+            dpi: Rasterization resolution
+            lang: Tesseract language code(s), e.g. "eng" or "eng+fra"
+            transfer: Shared src.s3_transfer.S3Transfer for bucket_name; one is
+                created if not given
+        """
+        self.bucket_name = bucket_name
+        self.book_name = book_name
+        self.cache = cache
+        self.workers = workers or os.cpu_count() or 1
+        self.dpi = dpi
+        self.lang = lang
+        if transfer is None:
+            from src.s3_transfer import S3Transfer
+            transfer = S3Transfer(bucket_name)
+        self.transfer = transfer
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._pool
+
+    def close(self):
+        """Stop the OCR processes"""
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    @property
+    def engine_version(self):
+        """Tesseract version plus the settings that change its output"""
+        import pytesseract
+        return f"{self.ENGINE_VERSION}-{pytesseract.get_tesseract_version()}-{self.dpi}dpi-{self.lang}"
+
+    def process_batch(self, s3_key, start_page, end_page):
+        """Process single batch with local OCR and return structured text"""
+        pages = self.extract_pages(s3_key, start_page, end_page)
+        text_key = processed_text_key(self.book_name, s3_key)
+        return save_processed_text(self.transfer, text_key, format_pages(pages))
+
+    def extract_pages(self, s3_key, start_page, end_page):
+        """OCR a batch locally and return its pages"""
+        pdf_data = self.transfer.get(s3_key)
+
+        # Skip OCR entirely if these exact pages were processed before
+        cache_key = None
+        if self.cache is not None:
+            cache_key = ocr_cache_key(pdf_data, self.ENGINE_NAME, self.engine_version, start_page)
+            cached = load_cached_pages(self.cache, cache_key)
+            if cached is not None:
+                logger.info(f"OCR cache hit for {s3_key}")
+                return cached
+
+        num_pages = min(len(PdfReader(io.BytesIO(pdf_data)).pages), end_page - start_page + 1)
+
+        # Workers open the batch by path instead of receiving its bytes with every page
+        with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as f:
+            f.write(pdf_data)
+            pdf_path = f.name
+        started = time.monotonic()
+        try:
+            results = list(self._get_pool().map(
+                _ocr_page,
+                [pdf_path] * num_pages,
+                range(num_pages),
+                [self.dpi] * num_pages,
+                [self.lang] * num_pages
+            ))
+        finally:
+            os.remove(pdf_path)
+        elapsed = max(time.monotonic() - started, 1e-6)
+
+        logger.info(f"Local OCR of {num_pages} pages took {elapsed:.1f}s "
+                    f"({num_pages / elapsed:.2f} pages/s on a pool of {self.workers})")
+
+        pages = [
+            make_page(start_page + i, text, confidence)
+            for i, (text, confidence) in enumerate(results)
+        ]
+
+        if cache_key and pages:
+            store_cached_pages(self.cache, cache_key, pages)
+
+        return pages
@@ -0,0 +1,97 @@
+#manifest.py
+import json
+import threading
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+class RunManifest:
+    """
+    Progress of one digitization run, kept as JSON in S3 so a restarted task
+    can skip finished stages and resume from the first unfinished batch.
+
+    Layout:
+        {
+            "source_id": "<ETag of the source PDF>",
+            "config": {"llm_model_id": ..., "prompts": "<hash>", ...},
+            "stages": {"split": {"completed_at": ...}, ...},
+            "batch_size": 20,
+            "batch_metadata": [...],
+            "batches": {"1": {"parsed_key": ..., "toc_mapping": {...}, "current_chapter": ...}}
+        }
+    """
+
+    def __init__(self, transfer, book_name):
+        """
+        Args:
+            transfer: src.s3_transfer.S3Transfer for the book's bucket
+        """
+        self.transfer = transfer
+        self.key = f"{book_name}/output/manifest.json"
+        self.data = self._empty()
+        self._lock = threading.Lock()
+
+    def _empty(self, source_id=None, config=None):
+        return {"source_id": source_id, "config": config, "stages": {}, "batch_size": None,
+                "batch_metadata": [], "batches": {}}
+
+    def load(self):
+        """Load the manifest from S3; returns False if there is none"""
+        body = self.transfer.get_if_exists(self.key)
+        if body is None:
+            return False
+
+        self.data = json.loads(body)
+        logger.info(f"Loaded manifest {self.key}: stages={list(self.data['stages'])}, "
+                    f"batches={len(self.data['batches'])}")
+        return True
+
+    def save(self):
+        with self._lock:
+            body = json.dumps(self.data, indent=2)
+        self.transfer.put(self.key, body, 'application/json')
+
+    def reset(self, source_id=None, config=None):
+        """Forget all progress and save the empty manifest"""
+        with self._lock:
+            self.data = self._empty(source_id, config)
+        self.save()
+
+    def is_stage_complete(self, stage):
+        return stage in self.data["stages"]
+
+    def complete_stage(self, stage):
+        with self._lock:
+            self.data["stages"][stage] = {"completed_at": datetime.now(timezone.utc).isoformat()}
+        self.save()
+
+    def clear_stages(self, stages):
+        """Mark stages as not done because their input changed"""
+        with self._lock:
+            cleared = [stage for stage in stages if self.data["stages"].pop(stage, None) is not None]
+        if cleared:
+            logger.info(f"Cleared stages {cleared}, their input changed")
+            self.save()
+
+    def set_batches(self, batch_size, batch_metadata):
+        """Record how the PDF was split; batch results only make sense against this"""
+        with self._lock:
+            self.data["batch_size"] = batch_size
+            self.data["batch_metadata"] = batch_metadata
+            self.data["batches"] = {}
+        self.save()
+
+    def complete_batch(self, batch_num, parsed_key, toc_mapping, current_chapter):
+        """Record a parsed batch and the chapter context after it"""
+        with self._lock:
+            self.data["batches"][str(batch_num)] = {
+                "parsed_key": parsed_key,
+                "toc_mapping": dict(toc_mapping or {}),
+                "current_chapter": current_chapter
+            }
+        self.save()
+
+    def completed_batches(self):
+        """Batch records keyed by 1-based batch number"""
+        return {int(num): record for num, record in self.data["batches"].items()}
@@ -0,0 +1,97 @@
+#ocr_pages.py
+"""
+Per-page OCR results shared by the OCR processors.
+
+A page is a dict {"page_number": int, "text": str, "confidence": float or None},
+with confidence in 0-1 when the engine reports one. The text handed to the
+LLM is the pages joined with "--- PAGE n ---" markers.
+
+Engines asked to keep geometry add "lines" (line texts in reading order) and
+"boxes", an array('f') of normalized [left, top, width, height] per line,
+flattened so a dense page costs 16 bytes per line instead of a dict.
+"""
+import json
+import re
+import logging
+from array import array
+
+logger = logging.getLogger(__name__)
+
+PAGE_MARKER = re.compile(r'^--- PAGE (\d+) ---$', re.MULTILINE)
+
+
+def make_page(page_number, text, confidence=None, lines=None, boxes=None):
+    page = {"page_number": page_number, "text": text, "confidence": confidence}
+    if boxes is not None:
+        page["lines"] = lines
+        page["boxes"] = boxes
+    return page
+
+
+def page_line_boxes(page):
+    """Yield (line_text, left, top, width, height) for a page with geometry"""
+    boxes = page["boxes"]
+    for i, line in enumerate(page["lines"]):
+        yield (line,) + tuple(boxes[i * 4:i * 4 + 4])
+
+
+def mean_confidence(confidences):
+    """Average of the given confidences, or None if there are none"""
+    confidences = [c for c in confidences if c is not None]
+    if not confidences:
+        return None
+    return sum(confidences) / len(confidences)
+
+
+def format_pages(pages):
+    """Join pages into the '--- PAGE n ---' text format"""
+    result = []
+    for page in sorted(pages, key=lambda p: p['page_number']):
+        result.append(f"\n--- PAGE {page['page_number']} ---\n")
+        if page['text']:
+            result.append(page['text'])
+    return '\n'.join(result)
+
+
+def split_pages(structured_text):
+    """Split '--- PAGE n ---' text back into pages (without confidence)"""
+    pages = []
+    markers = list(PAGE_MARKER.finditer(structured_text))
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(structured_text)
+        pages.append(make_page(int(marker.group(1)), structured_text[marker.end():end].strip('\n')))
+    return pages
+
+
+def processed_text_key(book_name, s3_key):
+    """S3 key the OCR text for a batch PDF is saved under"""
+    batch_filename = s3_key.split('/')[-1].replace('.pdf', '')
+    return f"{book_name}/output/processed/{batch_filename}.txt"
+
+
+def save_processed_text(transfer, text_key, structured_text):
+    """Save processed text through an S3Transfer and return its key"""
+    transfer.put(text_key, structured_text, 'text/plain')
+
+    logger.info(f"Saved processed text: {text_key}")
+    return text_key
+
+
+def load_cached_pages(cache, cache_key):
+    """Pages stored under cache_key, or None on a miss"""
+    cached = cache.get(cache_key)
+    if cached is None:
+        return None
+    pages = json.loads(cached)
+    for page in pages:
+        if page.get("boxes") is not None:
+            page["boxes"] = array('f', page["boxes"])
+    return pages
+
+
+def store_cached_pages(cache, cache_key, pages):
+    serializable = [
+        dict(page, boxes=page["boxes"].tolist()) if page.get("boxes") is not None else page
+        for page in pages
+    ]
+    cache.put(cache_key, json.dumps(serializable).encode('utf-8'))
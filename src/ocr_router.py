@@ -0,0 +1,226 @@
+#ocr_router.py
+import io
+import threading
+import logging
+from PyPDF2 import PdfReader, PdfWriter
+from src.layout import analyze_page
+from src.ocr_pages import format_pages, processed_text_key, save_processed_text
+
+logger = logging.getLogger(__name__)
+
+# Engine name -> factory(bucket_name, book_name, gcs_bucket_name, cache, **options).
+# Engines expose extract_pages(s3_key, start_page, end_page) returning a list
+# of pages (see src.ocr_pages), or None if the whole batch failed.
+OCR_ENGINES = {}
+# Engines whose constructor accepts keep_geometry=True
+GEOMETRY_ENGINES = set()
+
+
+def register_engine(name, factory, geometry=False):
+    """Make an OCR engine available by name"""
+    OCR_ENGINES[name] = factory
+    if geometry:
+        GEOMETRY_ENGINES.add(name)
+
+
+def create_engine(name, bucket_name, book_name, gcs_bucket_name=None, cache=None, options=None):
+    """Build an engine; options are passed to its constructor as keyword arguments"""
+    if name not in OCR_ENGINES:
+        raise ValueError(f"Unknown OCR engine: {name} (available: {', '.join(sorted(OCR_ENGINES))})")
+    return OCR_ENGINES[name](bucket_name, book_name, gcs_bucket_name, cache, **(options or {}))
+
+
+def _google_vision(bucket_name, book_name, gcs_bucket_name, cache, **options):
+    from src.google_vision_processor import GoogleVisionProcessor
+    return GoogleVisionProcessor(bucket_name, gcs_bucket_name, book_name, cache=cache, **options)
+
+
+def _textract(bucket_name, book_name, gcs_bucket_name, cache, **options):
+    from src.textract_processor import TextractProcessor
+    return TextractProcessor(bucket_name, book_name, cache=cache, **options)
+
+
+def _local(bucket_name, book_name, gcs_bucket_name, cache, **options):
+    from src.local_ocr_processor import LocalOCRProcessor
+    return LocalOCRProcessor(bucket_name, book_name, cache=cache, **options)
+
+
+register_engine("google-vision", _google_vision, geometry=True)
+register_engine("textract", _textract, geometry=True)
+register_engine("local", _local)
+
+
+def parse_engine_routes(spec):
+    """
+    Parse a routing spec like "1-40:textract,41-:local" into
+    [(1, 40, "textract"), (41, None, "local")]. A batch goes to the first
+    route containing its start page.
+    """
+    routes = []
+    for part in filter(None, (p.strip() for p in (spec or "").split(','))):
+        page_range, engine = part.split(':')
+        first, _, last = page_range.partition('-')
+        routes.append((int(first), int(last) if last else None, engine.strip()))
+    return routes
+
+
+class OCRRouter:
+    """
+    Picks an OCR engine per batch and re-OCRs only the pages that came back
+    empty or below min_confidence with a fallback engine. Has the same
+    process_batch contract as the individual processors.
+    """
+
+    def __init__(self, bucket_name, book_name, engine="google-vision", fallback_engine=None,
+                 routes=None, min_confidence=0.5, gcs_bucket_name=None, cache=None,
+                 engine_options=None, layout=False, transfer=None):
+        """
+        Args:
+            engine: Default engine name
+            fallback_engine: Engine for pages the first engine got wrong, if any
+            routes: Per page-range engine overrides, see parse_engine_routes
+            min_confidence: Pages with a lower reported confidence are retried
+            engine_options: {engine name: constructor keyword arguments}
+            layout: Run layout analysis (src.layout) on engines that report geometry
+            transfer: src.s3_transfer.S3Transfer shared with the engines; one is
+                created if not given
+        """
+        for name in [engine, fallback_engine] + [route[2] for route in routes or []]:
+            if name is not None and name not in OCR_ENGINES:
+                raise ValueError(f"Unknown OCR engine: {name}")
+        self.bucket_name = bucket_name
+        self.book_name = book_name
+        self.default_engine = engine
+        self.fallback_engine = fallback_engine
+        self.routes = routes or []
+        self.min_confidence = min_confidence
+        self.gcs_bucket_name = gcs_bucket_name
+        self.cache = cache
+        self.engine_options = engine_options or {}
+        self.layout = layout
+        if transfer is None:
+            from src.s3_transfer import S3Transfer
+            transfer = S3Transfer(bucket_name)
+        self.transfer = transfer
+        self.pages_retried = 0
+        self.pages_recovered = 0
+        self.layout_chars_in = 0
+        self.layout_chars_out = 0
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    def engine_for_batch(self, start_page):
+        for first, last, engine in self.routes:
+            if start_page >= first and (last is None or start_page <= last):
+                return engine
+        return self.default_engine
+
+    def _engine(self, name):
+        with self._lock:
+            if name not in self._engines:
+                options = dict(self.engine_options.get(name) or {})
+                options.setdefault('transfer', self.transfer)
+                if self.layout and name in GEOMETRY_ENGINES:
+                    options['keep_geometry'] = True
+                self._engines[name] = create_engine(
+                    name, self.bucket_name, self.book_name, self.gcs_bucket_name, self.cache, options
+                )
+            return self._engines[name]
+
+    def process_batch(self, s3_key, start_page, end_page):
+        """OCR a batch, retry bad pages with the fallback engine, and save the text"""
+        engine_name = self.engine_for_batch(start_page)
+        pages = self._engine(engine_name).extract_pages(s3_key, start_page, end_page)
+        if pages is None:
+            logger.warning(f"{engine_name} failed for {s3_key}")
+            pages = []
+
+        by_number = {page['page_number']: page for page in pages}
+        bad_pages = [
+            n for n in range(start_page, end_page + 1)
+            if n not in by_number or self._needs_fallback(by_number[n])
+        ]
+
+        fallback = self.fallback_engine
+        if bad_pages and fallback and fallback != engine_name:
+            logger.info(f"Re-OCRing {len(bad_pages)} pages of {s3_key} with {fallback}")
+            for page in self._reocr_pages(fallback, s3_key, start_page, bad_pages):
+                current = by_number.get(page['page_number'])
+                if current is None or self._is_better(page, current):
+                    by_number[page['page_number']] = page
+                    if not self._needs_fallback(page):
+                        with self._lock:
+                            self.pages_recovered += 1
+
+        if not by_number:
+            return None
+
+        pages = list(by_number.values())
+        if self.layout:
+            pages = self._apply_layout(pages)
+
+        text_key = processed_text_key(self.book_name, s3_key)
+        return save_processed_text(self.transfer, text_key, format_pages(pages))
+
+    def _apply_layout(self, pages):
+        laid_out = [analyze_page(page) for page in pages]
+        with self._lock:
+            self.layout_chars_in += sum(len(page['text']) for page in pages)
+            self.layout_chars_out += sum(len(page['text']) for page in laid_out)
+        return laid_out
+
+    def _needs_fallback(self, page):
+        if not page['text'].strip():
+            return True
+        return page['confidence'] is not None and page['confidence'] < self.min_confidence
+
+    def _is_better(self, candidate, current):
+        if not candidate['text'].strip():
+            return False
+        if not current['text'].strip():
+            return True
+        return (candidate['confidence'] or 0) > (current['confidence'] or 0)
+
+    def _reocr_pages(self, engine_name, s3_key, start_page, page_numbers):
+        """Run the given pages of a batch through another engine as a small PDF"""
+        reader = PdfReader(io.BytesIO(self.transfer.get(s3_key)))
+
+        writer = PdfWriter()
+        for page_number in page_numbers:
+            writer.add_page(reader.pages[page_number - start_page])
+        buffer = io.BytesIO()
+        writer.write(buffer)
+
+        batch_filename = s3_key.split('/')[-1].replace('.pdf', '')
+        retry_key = f"{self.book_name}/input/retry/{batch_filename}-{engine_name}.pdf"
+        self.transfer.put(retry_key, buffer.getvalue(), 'application/pdf')
+        with self._lock:
+            self.pages_retried += len(page_numbers)
+
+        try:
+            retried = self._engine(engine_name).extract_pages(retry_key, 1, len(page_numbers)) or []
+        finally:
+            self.transfer.delete(retry_key)
+
+        # Map pages of the retry PDF back to their book page numbers
+        return [
+            dict(page, page_number=page_numbers[page['page_number'] - 1])
+            for page in retried
+            if 1 <= page['page_number'] <= len(page_numbers)
+        ]
+
+    def close(self):
+        """Release the engines' resources, e.g. local OCR processes"""
+        with self._lock:
+            engines = list(self._engines.values())
+        for engine in engines:
+            if hasattr(engine, 'close'):
+                engine.close()
+
+    def stats(self):
+        return {
+            "pages_retried": self.pages_retried,
+            "pages_recovered": self.pages_recovered,
+            "layout_chars_in": self.layout_chars_in,
+            "layout_chars_out": self.layout_chars_out
+        }
@@ -0,0 +1,128 @@
+#page_classifier.py
+"""
+Finds OCR pages simple enough to skip the LLM.
+
+Blank pages, image-only plates and plain running prose are turned into the
+page records parse_markdown_response produces; anything that might hold a
+heading, footnote, table, TOC entry, verse or non-Latin script goes to the
+LLM. The rules are deliberately conservative: a page sent to the LLM that
+did not need it costs tokens, a page wrongly skipped loses structure.
+"""
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+BLANK = "blank"
+IMAGE_ONLY = "image_only"
+PROSE = "prose"
+LLM = "llm"
+
+FIGURE_PLACEHOLDER = re.compile(r'^\[FIGURE_PLACEHOLDER_\d+\]$')
+HEADING_WORDS = re.compile(r'^(chapter|book|part|section|appendix|preface|introduction|contents|index)\b',
+                           re.IGNORECASE)
+# Footnote symbols, layout tags, table rules and dot leaders
+STRUCTURE_MARKS = re.compile(r'[*†‡§¶|]|\[(FOOTNOTE|MARGINALIA)\]|\.{4,}|…{2,}')
+ROMAN_NUMERAL = re.compile(r'^[IVXLC]+\.?$')
+# A line ending a sentence, possibly inside closing quotes or brackets
+SENTENCE_END = re.compile(r'[.!?:]["\'”’)\]]*$')
+SHORT_LINE = 0.7
+
+
+def _paragraphs(text):
+    """
+    Lines of a page grouped into paragraphs. OCR text rarely keeps blank lines,
+    so a line that stops short of the measure at the end of a sentence also
+    closes a paragraph.
+    """
+    lines = [line.strip() for line in text.split('\n')]
+    measure = max((len(line) for line in lines), default=0)
+    paragraphs, current = [], []
+    for line in lines:
+        if line:
+            current.append(line)
+        if current and (not line or (len(line) < measure * SHORT_LINE and SENTENCE_END.search(line))):
+            paragraphs.append(current)
+            current = []
+    if current:
+        paragraphs.append(current)
+    return paragraphs
+
+
+def classify_page(text, min_prose_chars=400, min_long_line_share=0.8, min_measure=45):
+    """
+    One of BLANK, IMAGE_ONLY, PROSE or LLM for a page's OCR text.
+
+    Args:
+        min_prose_chars: Shorter pages are not trusted as plain prose
+        min_long_line_share: Share of lines that must run to the full measure
+        min_measure: Characters in the longest line; narrower columns are verse or lists
+    """
+    lines = [line.strip() for line in text.split('\n') if line.strip()]
+    if not lines:
+        return BLANK
+
+    words = [line for line in lines if not FIGURE_PLACEHOLDER.match(line)]
+    if not words:
+        return IMAGE_ONLY
+    # Specks and rules only; a lone "IV" may still be a part divider
+    if not any(ch.isalnum() for line in words for ch in line):
+        return BLANK
+
+    body = '\n'.join(words)
+    if len(body) < min_prose_chars:
+        return LLM
+    if len(words) != len(lines) or STRUCTURE_MARKS.search(body):
+        return LLM
+    if any(ord(ch) > 0x24F for ch in body):
+        return LLM  # beyond Latin Extended: Arabic, Greek, ... need translation handling
+
+    for line in words:
+        if HEADING_WORDS.match(line) or ROMAN_NUMERAL.match(line):
+            return LLM
+        letters = [ch for ch in line if ch.isalpha()]
+        if len(letters) > 3 and all(ch.isupper() for ch in letters):
+            return LLM
+
+    # Running prose fills the measure; short lines mean verse, lists or headings.
+    # The last line of each paragraph is allowed to be short, so a short line
+    # that does not end a sentence counts against the page.
+    measure = max(len(line) for line in words)
+    if measure < min_measure:
+        return LLM
+    # Running heads, page numbers and catchwords the cleanup missed sit on the
+    # first or last line; only the ends of paragraphs may be short there
+    first, last = words[0], words[-1]
+    if any(not any(ch.isalpha() for ch in line) for line in (first, last)):
+        return LLM  # a bare page number
+    if len(first) < measure * SHORT_LINE and not (first[0].islower() and SENTENCE_END.search(first)):
+        return LLM
+    if len(last) < measure * SHORT_LINE and not SENTENCE_END.search(last):
+        return LLM
+    paragraphs = _paragraphs(body)
+    # A short line standing alone mid-page is a heading, list item or verse
+    # line; the first and last may be the ends of paragraphs on other pages
+    if any(len(paragraph) == 1 and len(paragraph[0]) < measure * SHORT_LINE for paragraph in paragraphs[1:-1]):
+        return LLM
+    inner_lines = [line for paragraph in paragraphs for line in paragraph[:-1]]
+    if inner_lines:
+        long_lines = sum(len(line) >= measure * SHORT_LINE for line in inner_lines)
+        if long_lines < len(inner_lines) * min_long_line_share:
+            return LLM
+
+    return PROSE
+
+
+def local_page(page_number, text, kind, chapter):
+    """Page record in parse_markdown_response's shape for a page the LLM skipped"""
+    if kind == PROSE:
+        content = '\n\n'.join(' '.join(' '.join(paragraph).split()) for paragraph in _paragraphs(text))
+    else:
+        content = ""
+    return {
+        "page_number": str(page_number),
+        "content": content,
+        "chapter": chapter,
+        "chapter_start": False,
+        "has_images": False
+    }
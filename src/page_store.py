@@ -0,0 +1,137 @@
+#page_store.py
+"""
+In-memory store of a book's parsed pages.
+
+Pages are kept as compact PageRecords indexed by integer page number, by
+chapter and by batch, so image linking, chapter grouping and the Quarto
+build look pages up instead of rescanning every batch. The store persists
+as JSONL, one page per line.
+"""
+import json
+import bisect
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class PageRecord:
+    """One parsed page, as produced by LLMParser in dict form"""
+    __slots__ = ("page_number", "batch", "content", "chapter", "chapter_start", "has_images")
+
+    def __init__(self, page_number, batch, content, chapter=None, chapter_start=False, has_images=False):
+        self.page_number = page_number
+        self.batch = batch
+        self.content = content
+        self.chapter = chapter
+        self.chapter_start = chapter_start
+        self.has_images = has_images
+
+    @classmethod
+    def from_dict(cls, page, batch):
+        return cls(
+            int(page['page_number']),
+            batch,
+            page['content'],
+            chapter=page.get('chapter'),
+            chapter_start=page.get('chapter_start', False),
+            has_images=page.get('has_images', False)
+        )
+
+    def to_dict(self):
+        """The page in the parsed batch JSON shape (page_number as a string)"""
+        return {
+            "page_number": str(self.page_number),
+            "content": self.content,
+            "chapter": self.chapter,
+            "chapter_start": self.chapter_start,
+            "has_images": self.has_images
+        }
+
+    def __repr__(self):
+        return f"PageRecord({self.page_number}, chapter={self.chapter!r})"
+
+
+class PageStore:
+    """Parsed pages of a book; batches can be added in any order and replaced"""
+
+    def __init__(self):
+        self._pages = {}       # page number -> PageRecord
+        self._by_batch = {}    # batch index -> [page numbers] in page order
+        self._by_chapter = {}  # chapter -> sorted [page numbers]
+        self._toc = {}         # batch index -> toc_extracted
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __iter__(self):
+        """Records in page order"""
+        return (self._pages[n] for n in sorted(self._pages))
+
+    def get(self, page_number):
+        return self._pages.get(int(page_number))
+
+    def add_batch(self, batch, parsed_data):
+        """Add (or replace) a parsed batch dict; returns its records in page order"""
+        self._remove_batch(batch)
+        records = [PageRecord.from_dict(page, batch) for page in parsed_data.get('pages', [])]
+        for record in records:
+            self._add(record)
+        self._toc[batch] = dict(parsed_data.get('toc_extracted') or {})
+        return records
+
+    def _add(self, record):
+        previous = self._pages.get(record.page_number)
+        if previous is not None:
+            logger.warning(f"Page {record.page_number} parsed again in batch {record.batch + 1}, "
+                           f"replacing batch {previous.batch + 1}'s version")
+            self._unindex(previous)
+        self._pages[record.page_number] = record
+        bisect.insort(self._by_batch.setdefault(record.batch, []), record.page_number)
+        bisect.insort(self._by_chapter.setdefault(record.chapter, []), record.page_number)
+
+    def _unindex(self, record):
+        self._by_batch[record.batch].remove(record.page_number)
+        self._by_chapter[record.chapter].remove(record.page_number)
+        if not self._by_chapter[record.chapter]:
+            del self._by_chapter[record.chapter]
+
+    def _remove_batch(self, batch):
+        for page_number in list(self._by_batch.get(batch, [])):
+            self._unindex(self._pages.pop(page_number))
+        self._by_batch.pop(batch, None)
+        self._toc.pop(batch, None)
+
+    def batches(self):
+        return sorted(self._by_batch)
+
+    def batch_pages(self, batch):
+        return [self._pages[n] for n in self._by_batch.get(batch, [])]
+
+    def batch_dict(self, batch):
+        """A batch in the parsed batch JSON shape, for saving back to S3"""
+        return {
+            "pages": [record.to_dict() for record in self.batch_pages(batch)],
+            "toc_extracted": dict(self._toc.get(batch, {}))
+        }
+
+    def chapters(self):
+        """Chapter names in order of their first page"""
+        return sorted(self._by_chapter, key=lambda chapter: self._by_chapter[chapter][0])
+
+    def chapter_pages(self, chapter):
+        return [self._pages[n] for n in self._by_chapter.get(chapter, [])]
+
+    def to_jsonl(self):
+        return '\n'.join(
+            json.dumps(dict(record.to_dict(), page_number=record.page_number, batch=record.batch))
+            for record in self
+        )
+
+    @classmethod
+    def from_jsonl(cls, text):
+        store = cls()
+        for line in text.splitlines():
+            if line.strip():
+                data = json.loads(line)
+                store._add(PageRecord.from_dict(data, data['batch']))
+        return store
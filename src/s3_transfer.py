@@ -0,0 +1,250 @@
+#s3_transfer.py
+"""
+Shared S3 transfer layer for BookDigitizer.
+
+One client with a connection pool sized for a thread pool of transfers:
+many small objects go through the *_many methods in parallel, large bodies
+are uploaded multipart, listings follow pagination past 1000 keys, and every
+request is timed for the run's transfer report.
+"""
+import io
+import copy
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+
+class _OperationStats:
+    __slots__ = ("count", "errors", "bytes", "seconds", "latencies")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.latencies = []
+
+    def for_bucket(self, bucket_name):
+        """
+        Single-object transfers (put, get, copy, delete) on another bucket,
+        sharing this transfer's client and report
+        """
+        if bucket_name == self.bucket_name:
+            return self
+        other = copy.copy(self)
+        other.bucket_name = bucket_name
+        return other
+
+    def report(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(share):
+            return round(1000 * latencies[min(len(latencies) - 1, int(len(latencies) * share))], 1)
+
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "mean_ms": round(1000 * self.seconds / self.count, 1) if self.count else 0.0,
+            "p50_ms": percentile(0.5) if latencies else 0.0,
+            "p95_ms": percentile(0.95) if latencies else 0.0
+        }
+
+
+class S3Transfer:
+    """Thread-safe S3 transfers for one bucket, with per-operation timing"""
+
+    def __init__(self, bucket_name, max_workers=16, multipart_threshold=8 * MB,
+                 multipart_chunksize=8 * MB, multipart_concurrency=4):
+        """
+        Args:
+            bucket_name: Bucket every key is read from and written to
+            max_workers: Concurrent requests for the *_many methods
+            multipart_threshold: Bodies larger than this are uploaded in parts
+            multipart_chunksize: Size of each part
+            multipart_concurrency: Parts of one upload sent at once
+        """
+        self.bucket_name = bucket_name
+        self.max_workers = max(1, max_workers)
+        self.multipart_threshold = multipart_threshold
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=multipart_concurrency
+        )
+        # Room for every pool thread plus the parts of a multipart upload
+        self.client = boto3.client('s3', config=Config(
+            max_pool_connections=self.max_workers + multipart_concurrency,
+            retries={'mode': 'standard', 'max_attempts': 5}
+        ))
+        self._pool = None
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.started = time.monotonic()
+
+    def _timed(self, operation, call, size=0):
+        started = time.monotonic()
+        try:
+            result = call()
+        except Exception:
+            self._record(operation, time.monotonic() - started, 0, failed=True)
+            raise
+        if callable(size):
+            size = size(result)
+        self._record(operation, time.monotonic() - started, size)
+        return result
+
+    def _record(self, operation, seconds, size, failed=False):
+        with self._lock:
+            stats = self._stats.setdefault(operation, _OperationStats())
+            stats.count += 1
+            stats.errors += failed
+            stats.bytes += size
+            stats.seconds += seconds
+            stats.latencies.append(seconds)
+
+    def put(self, key, body, content_type=None):
+        """Write str or bytes to key, multipart when it is large"""
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if len(body) > self.multipart_threshold:
+            return self.upload_fileobj(io.BytesIO(body), key, content_type=content_type)
+
+        params = {'Bucket': self.bucket_name, 'Key': key, 'Body': body}
+        if content_type:
+            params['ContentType'] = content_type
+        self._timed('put', lambda: self.client.put_object(**params), len(body))
+        return key
+
+    def upload_fileobj(self, fileobj, key, content_type=None):
+        """Upload a file object, in parts above multipart_threshold"""
+        extra_args = {'ContentType': content_type} if content_type else None
+        size = fileobj.seek(0, io.SEEK_END)
+        fileobj.seek(0)
+        self._timed('upload', lambda: self.client.upload_fileobj(
+            fileobj, self.bucket_name, key, ExtraArgs=extra_args, Config=self.transfer_config
+        ), size)
+        return key
+
+    def get(self, key):
+        """Body of key as bytes"""
+        return self._timed(
+            'get',
+            lambda: self.client.get_object(Bucket=self.bucket_name, Key=key)['Body'].read(),
+            len
+        )
+
+    def get_if_exists(self, key):
+        """Body of key as bytes, or None if there is no such key; a miss is not an error"""
+        def call():
+            try:
+                return self.client.get_object(Bucket=self.bucket_name, Key=key)['Body'].read()
+            except ClientError as e:
+                if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                    return None
+                raise
+        return self._timed('get', call, lambda body: len(body or b''))
+
+    def copy(self, source_key, key):
+        """Server-side copy within the bucket"""
+        self._timed('copy', lambda: self.client.copy_object(
+            Bucket=self.bucket_name,
+            Key=key,
+            CopySource={'Bucket': self.bucket_name, 'Key': source_key}
+        ))
+        return key
+
+    def delete(self, key):
+        """Remove key from the bucket"""
+        self._timed('delete', lambda: self.client.delete_object(Bucket=self.bucket_name, Key=key))
+
+    def list_keys(self, prefix):
+        """Every key under prefix, following pagination"""
+        keys = []
+        pages = self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket_name, Prefix=prefix)
+        # Each page is one request, made as the paginator is advanced
+        started = time.monotonic()
+        for page in pages:
+            self._record('list', time.monotonic() - started, 0)
+            keys.extend(obj['Key'] for obj in page.get('Contents', []))
+            started = time.monotonic()
+        return keys
+
+    def put_many(self, items):
+        """put() each (key, body, content_type) in parallel"""
+        return self._map(lambda item: self.put(*item), items)
+
+    def get_many(self, keys):
+        """{key: body} for each key, fetched in parallel"""
+        keys = list(keys)
+        return dict(zip(keys, self._map(self.get, keys)))
+
+    def copy_many(self, pairs):
+        """copy() each (source_key, key) in parallel"""
+        return self._map(lambda pair: self.copy(*pair), pairs)
+
+    def _map(self, func, items):
+        """
+        Run func over items on the shared pool, in order. Every item is tried;
+        the first failure is raised once all are done. Not for use from inside
+        a pool task.
+        """
+        items = list(items)
+        if not items:
+            return []
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        futures = [self._pool.submit(func, item) for item in items]
+
+        results, errors = [], []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.error(f"S3 transfer failed: {e}")
+                errors.append(e)
+                results.append(None)
+        if errors:
+            raise errors[0]
+        return results
+
+    def for_bucket(self, bucket_name):
+        """
+        Single-object transfers (put, get, copy, delete) on another bucket,
+        sharing this transfer's client and report
+        """
+        if bucket_name == self.bucket_name:
+            return self
+        other = copy.copy(self)
+        other.bucket_name = bucket_name
+        return other
+
+    def report(self):
+        """Request counts, bytes and latency per operation, and overall throughput"""
+        with self._lock:
+            operations = {name: stats.report() for name, stats in self._stats.items()}
+        elapsed = time.monotonic() - self.started
+        total_bytes = sum(stats["bytes"] for stats in operations.values())
+        return {
+            "elapsed_seconds": round(elapsed, 1),
+            "requests": sum(stats["count"] for stats in operations.values()),
+            "bytes": total_bytes,
+            "mb_per_second": round(total_bytes / MB / elapsed, 2) if elapsed else 0.0,
+            "operations": operations
+        }
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
@@ -0,0 +1,349 @@
+#search_index.py
+"""
+Full-text inverted index over parsed pages, with phrase queries.
+
+An index is a directory of four files:
+    meta.json     books (document ids are positions in this list) and counts
+    pages.jsonl   one line per page: document, page number, chapter
+    terms.jsonl   one line per term, sorted by term: [term, postings]; each
+                  posting is [document, page, [token positions]]
+    lexicon.json  byte offset of each term's line in terms.jsonl
+
+IndexBuilder takes pages in one streaming pass, spilling sorted runs to disk
+when its postings outgrow memory and merging them at the end; merge_indexes
+combines the indexes of several books the same way. Words are normalized
+for 18th/19th-century spelling on both sides, so "shew" finds "show".
+
+    python -m src.search_index query INDEX_DIR 'ashanti "king of"'
+    python -m src.search_index merge OUT_DIR INDEX_DIR [INDEX_DIR ...]
+"""
+import os
+import re
+import json
+import heapq
+import logging
+import unicodedata
+from src.text_cleanup import CHARACTER_MAP
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 1
+INDEX_FILES = ('meta.json', 'pages.jsonl', 'terms.jsonl', 'lexicon.json')
+
+HISTORICAL_SPELLINGS = {
+    'shew': 'show',
+    'shewn': 'shown',
+    'shewed': 'showed',
+    'shewing': 'showing',
+    'shews': 'shows',
+    'connexion': 'connection',
+    'compleat': 'complete',
+    'chuse': 'choose',
+    'antient': 'ancient',
+    'croud': 'crowd',
+    'gaol': 'jail',
+    'despatch': 'dispatch',
+    'despatched': 'dispatched',
+    'ashantee': 'ashanti',
+    'ashantees': 'ashantis',
+}
+
+IMAGE_LINK = re.compile(r'!\[[^\]]*\]\([^)]*\)')
+# "arriv'd" -> "arrived"; not "he'd", "they'd", which are contractions
+ELIDED_ED = re.compile(r"\b(?!(?:i|you|he|she|it|we|they|who|that|there|what|where)'d\b)(\w{2,})'d\b")
+WORD = re.compile(r'[^\W_]+')
+
+
+def normalize_word(word, spellings=HISTORICAL_SPELLINGS):
+    """Modern spelling of a lowercased, accent-free word"""
+    word = spellings.get(word, word)
+    # "publick" -> "public", "colour" -> "color"; applied to queries too, so
+    # the odd over-normalized word still matches itself
+    if len(word) >= 6 and word.endswith('ick'):
+        return word[:-1]
+    if len(word) >= 6 and word.endswith('our'):
+        return word[:-2] + 'r'
+    return word
+
+
+def tokenize(text, spellings=HISTORICAL_SPELLINGS):
+    """Normalized words of a page or query, in order"""
+    text = IMAGE_LINK.sub(' ', text).translate(CHARACTER_MAP).lower()
+    text = ELIDED_ED.sub(r'\1ed', text)
+    text = ''.join(ch for ch in unicodedata.normalize('NFKD', text) if not unicodedata.combining(ch))
+    return [normalize_word(word, spellings) for word in WORD.findall(text)]
+
+
+class IndexBuilder:
+    """
+    Builds an index directory from a stream of pages. Pages of one book must
+    arrive together.
+    """
+
+    def __init__(self, out_dir, max_postings=500000, spellings=HISTORICAL_SPELLINGS):
+        """
+        Args:
+            out_dir: Directory to write the index to; created if missing
+            max_postings: Postings held in memory before a sorted run is spilled to disk
+        """
+        self.out_dir = out_dir
+        self.max_postings = max_postings
+        self.spellings = spellings
+        os.makedirs(out_dir, exist_ok=True)
+        self.books = []
+        self._postings = {}  # term -> [[doc, page, positions]]
+        self._in_memory = 0
+        self._runs = []
+        self._pages = open(os.path.join(out_dir, 'pages.jsonl'), 'w')
+        self.page_count = 0
+        self.token_count = 0
+
+    def add_page(self, book, page_number, chapter, text):
+        if not self.books or self.books[-1] != book:
+            if book in self.books:
+                raise ValueError(f"Pages of {book} must be added together")
+            self.books.append(book)
+        doc = len(self.books) - 1
+
+        self._pages.write(json.dumps([doc, page_number, chapter]) + '\n')
+        self.page_count += 1
+
+        positions = {}
+        tokens = tokenize(text, self.spellings)
+        for position, term in enumerate(tokens):
+            positions.setdefault(term, []).append(position)
+        for term, found in positions.items():
+            self._postings.setdefault(term, []).append([doc, page_number, found])
+        self._in_memory += len(positions)
+        self.token_count += len(tokens)
+
+        if self._in_memory >= self.max_postings:
+            self._spill()
+
+    def _spill(self):
+        """Write the in-memory postings as a sorted run"""
+        path = os.path.join(self.out_dir, f"run-{len(self._runs)}.jsonl")
+        with open(path, 'w') as f:
+            for term in sorted(self._postings):
+                f.write(json.dumps([term, self._postings[term]]) + '\n')
+        self._runs.append(path)
+        self._postings = {}
+        self._in_memory = 0
+
+    def finish(self):
+        """Merge the runs into terms.jsonl and write the lexicon and meta; returns meta"""
+        self._pages.close()
+        if self._postings or not self._runs:
+            self._spill()
+
+        term_count = _write_terms(self.out_dir, [_read_run(path) for path in self._runs])
+        for path in self._runs:
+            os.remove(path)
+
+        meta = {
+            "version": INDEX_VERSION,
+            "books": self.books,
+            "pages": self.page_count,
+            "tokens": self.token_count,
+            "terms": term_count
+        }
+        with open(os.path.join(self.out_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        logger.info(f"Built search index: {meta['pages']} pages, {meta['tokens']} tokens, "
+                    f"{meta['terms']} terms")
+        return meta
+
+
+def _read_run(path, doc_offset=0):
+    """(term, postings) pairs of a sorted terms file, with document ids shifted"""
+    with open(path) as f:
+        for line in f:
+            term, postings = json.loads(line)
+            if doc_offset:
+                postings = [[doc + doc_offset, page, positions] for doc, page, positions in postings]
+            yield term, postings
+
+
+def _write_terms(out_dir, sources):
+    """k-way merge sorted (term, postings) streams into terms.jsonl and lexicon.json"""
+    lexicon = {}
+    merged = heapq.merge(*sources, key=lambda entry: entry[0])
+    with open(os.path.join(out_dir, 'terms.jsonl'), 'wb') as f:
+        term, postings = None, []
+        for next_term, next_postings in merged:
+            if next_term != term:
+                if term is not None:
+                    lexicon[term] = f.tell()
+                    f.write((json.dumps([term, sorted(postings)]) + '\n').encode('utf-8'))
+                term, postings = next_term, []
+            postings.extend(next_postings)
+        if term is not None:
+            lexicon[term] = f.tell()
+            f.write((json.dumps([term, sorted(postings)]) + '\n').encode('utf-8'))
+
+    with open(os.path.join(out_dir, 'lexicon.json'), 'w') as f:
+        json.dump(lexicon, f)
+    return len(lexicon)
+
+
+def merge_indexes(index_dirs, out_dir):
+    """Combine the indexes of different books into one; returns its meta"""
+    metas = []
+    for index_dir in index_dirs:
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            metas.append(json.load(f))
+
+    books = [book for meta in metas for book in meta['books']]
+    duplicates = {book for book in books if books.count(book) > 1}
+    if duplicates:
+        raise ValueError(f"Books indexed more than once: {sorted(duplicates)}")
+
+    os.makedirs(out_dir, exist_ok=True)
+    offsets = []
+    offset = 0
+    with open(os.path.join(out_dir, 'pages.jsonl'), 'w') as out:
+        for index_dir, meta in zip(index_dirs, metas):
+            offsets.append(offset)
+            with open(os.path.join(index_dir, 'pages.jsonl')) as f:
+                for line in f:
+                    doc, page, chapter = json.loads(line)
+                    out.write(json.dumps([doc + offset, page, chapter]) + '\n')
+            offset += len(meta['books'])
+
+    term_count = _write_terms(out_dir, [
+        _read_run(os.path.join(index_dir, 'terms.jsonl'), doc_offset)
+        for index_dir, doc_offset in zip(index_dirs, offsets)
+    ])
+    meta = {
+        "version": INDEX_VERSION,
+        "books": books,
+        "pages": sum(meta['pages'] for meta in metas),
+        "tokens": sum(meta['tokens'] for meta in metas),
+        "terms": term_count
+    }
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    logger.info(f"Merged {len(index_dirs)} indexes: {len(books)} books, {meta['terms']} terms")
+    return meta
+
+
+class SearchIndex:
+    """Read side of an index directory"""
+
+    def __init__(self, index_dir, spellings=HISTORICAL_SPELLINGS):
+        self.index_dir = index_dir
+        self.spellings = spellings
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != INDEX_VERSION:
+            raise ValueError(f"Unsupported search index version: {self.meta.get('version')}")
+        with open(os.path.join(index_dir, 'lexicon.json')) as f:
+            self.lexicon = json.load(f)
+        self.chapters = {}
+        with open(os.path.join(index_dir, 'pages.jsonl')) as f:
+            for line in f:
+                doc, page, chapter = json.loads(line)
+                self.chapters[(doc, page)] = chapter
+        self._terms = open(os.path.join(index_dir, 'terms.jsonl'), 'rb')
+
+    def close(self):
+        self._terms.close()
+
+    def postings(self, term):
+        """{(doc, page): positions} for one normalized term"""
+        offset = self.lexicon.get(term)
+        if offset is None:
+            return {}
+        self._terms.seek(offset)
+        _, postings = json.loads(self._terms.readline())
+        return {(doc, page): positions for doc, page, positions in postings}
+
+    def _phrase(self, terms):
+        """{(doc, page): match count} for pages with the terms in sequence"""
+        first = self.postings(terms[0])
+        rest = [self.postings(term) for term in terms[1:]]
+        matches = {}
+        for key, starts in first.items():
+            if not all(key in postings for postings in rest):
+                continue
+            following = [set(postings[key]) for postings in rest]
+            count = sum(
+                all(start + i + 1 in positions for i, positions in enumerate(following))
+                for start in starts
+            )
+            if count:
+                matches[key] = count
+        return matches
+
+    def search(self, query, limit=20):
+        """
+        Pages matching every word and "quoted phrase" of the query, most hits
+        first: [{"book", "page", "chapter", "hits"}]
+        """
+        clauses = []
+        for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query):
+            terms = tokenize(phrase or word, self.spellings)
+            if terms:
+                clauses.append(terms)
+        if not clauses:
+            return []
+
+        hits = None
+        for terms in clauses:
+            matches = self._phrase(terms)
+            if hits is None:
+                hits = matches
+            else:
+                hits = {key: hits[key] + count for key, count in matches.items() if key in hits}
+            if not hits:
+                return []
+
+        ranked = sorted(hits.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [
+            {
+                "book": self.meta['books'][doc],
+                "page": page,
+                "chapter": self.chapters.get((doc, page)),
+                "hits": count
+            }
+            for (doc, page), count in ranked
+        ]
+
+
+def build_index(pages, out_dir, **options):
+    """Index (book, page_number, chapter, text) tuples; returns the index meta"""
+    builder = IndexBuilder(out_dir, **options)
+    for book, page_number, chapter, text in pages:
+        builder.add_page(book, page_number, chapter, text)
+    return builder.finish()
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Query or merge book search indexes")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    query = commands.add_parser('query', help='Search an index')
+    query.add_argument('index_dir')
+    query.add_argument('query', help='Words and "quoted phrases", all of which must match')
+    query.add_argument('--limit', type=int, default=20)
+
+    merge = commands.add_parser('merge', help='Merge the indexes of several books')
+    merge.add_argument('out_dir')
+    merge.add_argument('index_dirs', nargs='+')
+
+    args = parser.parse_args()
+    if args.command == 'query':
+        index = SearchIndex(args.index_dir)
+        try:
+            for hit in index.search(args.query, limit=args.limit):
+                print(f"{hit['book']}  p.{hit['page']}  [{hit['chapter']}]  {hit['hits']} hits")
+        finally:
+            index.close()
+    else:
+        merge_indexes(args.index_dirs, args.out_dir)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,200 @@
+#text_cleanup.py
+"""
+Deterministic cleanup of OCR text before it goes to the LLM.
+
+Works on the '--- PAGE n ---' text of a batch (see src.ocr_pages) and only
+does what does not need judgement: 1800s print characters and ligatures,
+words hyphenated across lines, running heads repeated across pages,
+bare page numbers and redundant whitespace.
+"""
+import re
+import threading
+import logging
+from collections import Counter
+from src.ocr_pages import format_pages, split_pages
+
+logger = logging.getLogger(__name__)
+
+CHARACTER_MAP = str.maketrans({
+    'ſ': 's',
+    'ﬀ': 'ff',
+    'ﬁ': 'fi',
+    'ﬂ': 'fl',
+    'ﬃ': 'ffi',
+    'ﬄ': 'ffl',
+    'ﬅ': 'st',
+    'ﬆ': 'st',
+    '\u00ad': None,  # soft hyphen
+    '\u200b': None,  # zero width space
+    '\ufeff': None,  # byte order mark
+    '\u00a0': ' ',   # no-break space
+})
+
+# "exam-\nple," -> "example,\n"; only lowercase continuations, so "Anglo-\nSaxon" stays.
+# The break after a continuation that fills its line is consumed, so no blank line appears
+HYPHENATED = re.compile(r'([a-z])-\n([a-z]+\S*)(?: |\n)?')
+# Bare page numbers; lowercase roman only, "IV" on its own is more likely a chapter numeral
+ARABIC_NUMBER = re.compile(r'^\d{1,4}$')
+ROMAN_NUMBER = re.compile(r'^m{0,4}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})$')
+ROMAN_VALUES = {'i': 1, 'v': 5, 'x': 10, 'l': 50, 'c': 100, 'd': 500, 'm': 1000}
+# Numbered headings are never running heads, however often they sit at a page edge
+NUMBERED_HEADING = re.compile(r'^(chapter|chap|letter|part|book|section|canto|volume|vol|day)\b\.?\s*(\d+|[ivxlcdm]+)\b')
+SPACES = re.compile(r'[ \t]+')
+BLANK_LINES = re.compile(r'\n{3,}')
+
+# Lines looked at for running heads at each end of a page
+EDGE_LINES = 2
+# A page number must fit the numbering of a page at most this far away
+PAGE_NUMBER_DISTANCE = 3
+
+
+class TextCleaner:
+    """
+    Cleans batches of OCR text and keeps per-step counts of characters
+    removed across the book.
+    """
+
+    def __init__(self, min_repeats=3, min_repeat_share=0.25):
+        """
+        Args:
+            min_repeats: Pages a top/bottom line must appear on to be a running head
+            min_repeat_share: ...and the share of the batch's pages it must appear on
+        """
+        self.min_repeats = min_repeats
+        self.min_repeat_share = min_repeat_share
+        self.removed = Counter()
+        self.chars_in = 0
+        self.chars_out = 0
+        self._lock = threading.Lock()
+
+    def clean(self, structured_text):
+        """Clean one batch of '--- PAGE n ---' text"""
+        pages = split_pages(structured_text)
+        if not pages:
+            return structured_text
+
+        removed = Counter()
+        texts = [self._step(removed, 'characters', page['text'], lambda t: t.translate(CHARACTER_MAP))
+                 for page in pages]
+        texts = self._remove_edges(texts, [page['page_number'] for page in pages], removed)
+        texts = [self._step(removed, 'dehyphenation', text, lambda t: HYPHENATED.sub(r'\1\2\n', t))
+                 for text in texts]
+        texts = [self._step(removed, 'whitespace', text, _collapse_whitespace) for text in texts]
+
+        cleaned = format_pages(dict(page, text=text) for page, text in zip(pages, texts))
+        with self._lock:
+            self.removed.update(removed)
+            self.chars_in += len(structured_text)
+            self.chars_out += len(cleaned)
+        return cleaned
+
+    def _step(self, removed, name, text, func):
+        result = func(text)
+        removed[name] += len(text) - len(result)
+        return result
+
+    def _remove_edges(self, texts, page_numbers, removed):
+        """Drop running heads repeated across pages and bare page numbers at page edges"""
+        page_lines = [text.split('\n') for text in texts]
+        number_lines = _page_number_lines(page_lines, page_numbers)
+
+        counts = Counter()
+        for lines in page_lines:
+            counts.update({_head_key(line) for line in _edge_lines(lines)})
+        threshold = max(self.min_repeats, len(page_lines) * self.min_repeat_share)
+        running_heads = {key for key, count in counts.items() if key and count >= threshold}
+
+        result = []
+        for p, lines in enumerate(page_lines):
+            edges = set(_edge_indexes(lines))
+            kept = []
+            for i, line in enumerate(lines):
+                if i in edges and _head_key(line) in running_heads:
+                    removed['running_heads'] += len(line) + 1
+                elif i in number_lines.get(p, ()):
+                    removed['page_numbers'] += len(line) + 1
+                else:
+                    kept.append(line)
+            result.append('\n'.join(kept))
+        return result
+
+    def report(self):
+        """Characters removed per step, and in total, for the book so far"""
+        with self._lock:
+            removed = self.chars_in - self.chars_out
+            return {
+                "chars_in": self.chars_in,
+                "chars_out": self.chars_out,
+                "removed_percent": round(100 * removed / self.chars_in, 1) if self.chars_in else 0.0,
+                "removed_by_step": dict(self.removed)
+            }
+
+
+def _edge_indexes(lines):
+    """Indexes of the first and last EDGE_LINES non-empty lines of a page"""
+    filled = [i for i, line in enumerate(lines) if line.strip()]
+    return filled[:EDGE_LINES] + filled[-EDGE_LINES:]
+
+
+def parse_page_number(line):
+    """('arabic' or 'roman', value) for a line holding only a page number, else None"""
+    text = line.strip().strip('.,:;-–—()[]|*_ ')
+    if ARABIC_NUMBER.match(text):
+        return 'arabic', int(text)
+    if text and ROMAN_NUMBER.match(text):
+        values = [ROMAN_VALUES[ch] for ch in text]
+        return 'roman', sum(-v if v < next_v else v for v, next_v in zip(values, values[1:] + [0]))
+    return None
+
+
+def _page_number_lines(page_lines, page_numbers):
+    """
+    {page index: line indexes} of printed page numbers: the outermost line at
+    either end of a page, kept only when a nearby page's number runs in step
+    with it, so a page ending in "mix." or "1850." keeps its text.
+    """
+    candidates = []
+    for p, lines in enumerate(page_lines):
+        filled = [i for i, line in enumerate(lines) if line.strip()]
+        for i in sorted({filled[0], filled[-1]} if filled else ()):
+            number = parse_page_number(lines[i])
+            if number is not None:
+                candidates.append((p, i, number))
+
+    found = {}
+    for p, i, (kind, value) in candidates:
+        offset = value - page_numbers[p]
+        if any(q != p and other_kind == kind
+               and abs(page_numbers[q] - page_numbers[p]) <= PAGE_NUMBER_DISTANCE
+               and other_value - page_numbers[q] == offset
+               for q, _, (other_kind, other_value) in candidates):
+            found.setdefault(p, set()).add(i)
+    return found
+
+
+def _edge_lines(lines):
+    return [lines[i] for i in _edge_indexes(lines)]
+
+
+def _head_key(line):
+    """
+    Running-head identity of a line: case, spacing and one leading or trailing
+    page number ignored, so "12 MISSION TO ASHANTEE" and "MISSION TO ASHANTEE 13"
+    match. None for lines that cannot be running heads.
+    """
+    key = SPACES.sub(' ', line.strip().lower())
+    if NUMBERED_HEADING.match(key):
+        return None
+    words = key.split(' ')
+    if len(words) > 1 and parse_page_number(words[0]) is not None:
+        words = words[1:]
+    elif len(words) > 1 and parse_page_number(words[-1]) is not None:
+        words = words[:-1]
+    key = ' '.join(words)
+    # Bare numbers are handled as page numbers, not running heads
+    return key if len(key.strip('. ')) > 2 and parse_page_number(key) is None else None
+
+
+def _collapse_whitespace(text):
+    lines = [SPACES.sub(' ', line).strip() for line in text.split('\n')]
+    return BLANK_LINES.sub('\n\n', '\n'.join(lines)).strip('\n')
@@ -2,95 +2,425 @@
 import boto3
 import time
 import json
+import queue
+import threading
 import logging
+from array import array
+from src.cache import ocr_cache_key
+from src.ocr_pages import (
+    make_page, format_pages, processed_text_key, save_processed_text,
+    load_cached_pages, store_cached_pages
+)
 
 logger = logging.getLogger(__name__)
 
+FINISHED_STATUSES = ('SUCCEEDED', 'PARTIAL_SUCCESS', 'FAILED')
+
+
+class CompletionMessage:
+    """A Textract job completion notification"""
+
+    def __init__(self, job_id, status, ack=None, release=None):
+        self.job_id = job_id
+        self.status = status
+        self._ack = ack
+        self._release = release
+
+    def ack(self):
+        """The notification was handled; remove it from the queue"""
+        if self._ack:
+            self._ack()
+
+    def release(self):
+        """Not ours; make it visible to other consumers again"""
+        if self._release:
+            self._release()
+
+
+class SQSCompletionQueue:
+    """Textract completions delivered through an SNS topic subscribed by an SQS queue"""
+
+    def __init__(self, queue_url, region_name='us-east-1'):
+        self.queue_url = queue_url
+        self.sqs = boto3.client('sqs', region_name=region_name)
+
+    def receive(self, wait_seconds=20):
+        """Long-poll for completion messages"""
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=10,
+            WaitTimeSeconds=wait_seconds
+        )
+        messages = []
+        for message in response.get('Messages', []):
+            handle = message['ReceiptHandle']
+            release = lambda handle=handle: self.sqs.change_message_visibility(
+                QueueUrl=self.queue_url, ReceiptHandle=handle, VisibilityTimeout=5
+            )
+            try:
+                body = json.loads(message['Body'])
+                # SNS wraps the Textract notification unless raw delivery is enabled
+                notification = json.loads(body['Message']) if 'Message' in body else body
+                job_id, status = notification['JobId'], notification['Status']
+            except (ValueError, KeyError, TypeError):
+                # Not a Textract notification; leave it for whoever it is for
+                logger.warning(f"Skipping non-Textract message {message.get('MessageId')}")
+                release()
+                continue
+            messages.append(CompletionMessage(
+                job_id,
+                status,
+                ack=lambda handle=handle: self.sqs.delete_message(
+                    QueueUrl=self.queue_url, ReceiptHandle=handle
+                ),
+                release=release
+            ))
+        return messages
+
+
+class LocalCompletionQueue:
+    """In-process stand-in for SQSCompletionQueue, for tests and local runs"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def publish(self, job_id, status='SUCCEEDED'):
+        self._queue.put(CompletionMessage(job_id, status))
+
+    def receive(self, wait_seconds=20):
+        try:
+            messages = [self._queue.get(timeout=wait_seconds)]
+        except queue.Empty:
+            return []
+        while True:
+            try:
+                messages.append(self._queue.get_nowait())
+            except queue.Empty:
+                return messages
+
+
+class _CompletionDispatcher:
+    """Reads a completion queue in the background and wakes whoever waits on a job"""
+
+    # How many completions of not-yet-watched jobs to remember
+    MAX_UNCLAIMED = 1000
+
+    def __init__(self, completion_queue):
+        self.completion_queue = completion_queue
+        self._statuses = {}
+        self._watched = set()
+        # A job can finish before start_job gets to watch it; its message is
+        # kept so it can be acked once claimed
+        self._unclaimed = {}
+        # Jobs found finished by polling, whose notification may still come
+        self._polled = set()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def watch(self, job_id):
+        with self._cond:
+            message = self._unclaimed.pop(job_id, None)
+            if message:
+                self._statuses[job_id] = message.status
+                self._cond.notify_all()
+            else:
+                self._watched.add(job_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        if message:
+            message.ack()
+
+    def wait_any(self, job_ids, timeout):
+        """Statuses of any of job_ids that finished, waiting up to timeout for one"""
+        with self._cond:
+            self._cond.wait_for(lambda: any(j in self._statuses for j in job_ids), timeout)
+            return {j: self._statuses.pop(j) for j in list(job_ids) if j in self._statuses}
+
+    def finished_by_poll(self, job_ids):
+        """Stop waiting on jobs whose status was polled; their notification is acked if it comes"""
+        with self._cond:
+            for job_id in job_ids:
+                self._statuses.pop(job_id, None)
+                if job_id in self._watched:
+                    self._watched.discard(job_id)
+                    self._polled.add(job_id)
+
+    def _run(self):
+        while True:
+            try:
+                messages = self.completion_queue.receive()
+            except Exception as e:
+                logger.error(f"Reading Textract completions failed: {e}")
+                time.sleep(5)
+                continue
+            for message in messages:
+                with self._cond:
+                    ours = message.job_id in self._watched or message.job_id in self._polled
+                    if message.job_id in self._watched:
+                        self._watched.discard(message.job_id)
+                        self._statuses[message.job_id] = message.status
+                        self._cond.notify_all()
+                    elif ours:
+                        self._polled.discard(message.job_id)
+                    else:
+                        # A redelivery replaces the message; only its latest receipt can be acked
+                        self._unclaimed.pop(message.job_id, None)
+                        if len(self._unclaimed) >= self.MAX_UNCLAIMED:
+                            self._unclaimed.pop(next(iter(self._unclaimed)))
+                        self._unclaimed[message.job_id] = message
+                if ours:
+                    message.ack()
+                else:
+                    message.release()
+
+
+class _PollingDispatcher:
+    """
+    Polls every watched job from one background loop, for runs without a
+    completion queue. Threads waiting on their own batches share the loop
+    instead of each polling on its own.
+    """
+
+    def __init__(self, textract, poll_interval):
+        self.textract = textract
+        self.poll_interval = poll_interval
+        self._statuses = {}
+        self._watched = set()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def watch(self, job_id):
+        with self._cond:
+            self._watched.add(job_id)
+            self._cond.notify_all()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def wait_any(self, job_ids, timeout):
+        """Statuses of any of job_ids that finished, waiting up to timeout for one"""
+        with self._cond:
+            self._cond.wait_for(lambda: any(j in self._statuses for j in job_ids), timeout)
+            return {j: self._statuses.pop(j) for j in list(job_ids) if j in self._statuses}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._watched)
+                job_ids = list(self._watched)
+            for job_id in job_ids:
+                try:
+                    status = self.textract.get_document_text_detection(JobId=job_id, MaxResults=1)['JobStatus']
+                except Exception as e:
+                    logger.error(f"Polling Textract job {job_id} failed: {e}")
+                    continue
+                if status in FINISHED_STATUSES:
+                    with self._cond:
+                        self._watched.discard(job_id)
+                        self._statuses[job_id] = status
+                        self._cond.notify_all()
+            logger.info(f"Polled {len(job_ids)} Textract jobs")
+            time.sleep(self.poll_interval)
+
+
+class _PageAssembler:
+    """
+    Builds pages from Textract result pages as they arrive, so only LINE text
+    (and optionally line boxes) is kept instead of every block of the job.
+    """
+
+    def __init__(self, start_page, keep_geometry=False):
+        self.start_page = start_page
+        self.keep_geometry = keep_geometry
+        self.lines = {}
+        self.boxes = {}
+        self.figures = {}
+        self.confidence = {}
+
+    def add_blocks(self, blocks):
+        for block in blocks:
+            if 'Page' not in block:
+                continue
+            page_num = block['Page'] + self.start_page - 1
+            if page_num not in self.lines:
+                self.lines[page_num] = []
+                self.figures[page_num] = 0
+                self.confidence[page_num] = [0.0, 0]
+                if self.keep_geometry:
+                    self.boxes[page_num] = array('f')
+
+            if block['BlockType'] == 'LINE':
+                self.lines[page_num].append(block['Text'])
+                totals = self.confidence[page_num]
+                totals[0] += block.get('Confidence', 0) / 100
+                totals[1] += 1
+                if self.keep_geometry:
+                    box = block.get('Geometry', {}).get('BoundingBox', {})
+                    self.boxes[page_num].extend((
+                        box.get('Left', 0), box.get('Top', 0), box.get('Width', 0), box.get('Height', 0)
+                    ))
+            elif block['BlockType'] == 'WORD' and 'figure' in block['Text'].lower():
+                self.figures[page_num] += 1
+
+    def pages(self):
+        """Per-page text, figure placeholders and line confidence"""
+        pages = []
+        for page_num in sorted(self.lines):
+            total, count = self.confidence[page_num]
+            figures = [f"[FIGURE_PLACEHOLDER_{page_num}]"] * self.figures[page_num]
+            pages.append(make_page(
+                page_num,
+                '\n'.join(self.lines[page_num] + figures),
+                total / count if count else None,
+                lines=self.lines[page_num] if self.keep_geometry else None,
+                boxes=self.boxes.get(page_num)
+            ))
+        return pages
+
+
 class TextractProcessor:
-    def __init__(self, bucket_name, book_name):
+    ENGINE_NAME = "textract"
+    # Bump when the text extraction changes
+    ENGINE_VERSION = "text-detection-2"
+
+    def __init__(self, bucket_name, book_name, cache=None, notification_channel=None,
+                 completion_queue=None, poll_interval=3, fallback_poll_interval=60,
+                 keep_geometry=False, transfer=None):
+        """
+        Args:
+            cache: Optional OCR result cache (see src.cache)
+            notification_channel: {"SNSTopicArn": ..., "RoleArn": ...} Textract
+                publishes job completions to
+            completion_queue: Where those completions arrive (SQSCompletionQueue
+                or LocalCompletionQueue). Without one, every outstanding job of
+                this processor is polled from one shared loop.
+            poll_interval: Seconds between polling rounds when polling
+            fallback_poll_interval: With a completion queue, poll anyway after
+                this many seconds without news, in case a message was lost
+            keep_geometry: Keep line boxes on each page for layout analysis
+            transfer: Shared src.s3_transfer.S3Transfer for bucket_name; one is
+                created if not given
+        """
         self.bucket_name = bucket_name
         self.book_name = book_name
-        self.s3 = boto3.client('s3')
+        self.cache = cache
+        self.notification_channel = notification_channel
+        self.poll_interval = poll_interval
+        self.fallback_poll_interval = fallback_poll_interval
+        self.keep_geometry = keep_geometry
+        if transfer is None:
+            from src.s3_transfer import S3Transfer
+            transfer = S3Transfer(bucket_name)
+        self.transfer = transfer
         self.textract = boto3.client('textract', region_name='us-east-1')
-    
+        self.completion_queue = completion_queue
+        if completion_queue:
+            self.dispatcher = _CompletionDispatcher(completion_queue)
+        else:
+            self.dispatcher = _PollingDispatcher(self.textract, poll_interval)
+
     def process_batch(self, s3_key, start_page, end_page):
         """Process single batch with Textract and return structured text"""
-        # Start async text detection
-        response = self.textract.start_document_text_detection(
-            DocumentLocation={
+        pages = self.extract_pages(s3_key, start_page, end_page)
+        if pages is None:
+            return None
+
+        text_key = processed_text_key(self.book_name, s3_key)
+        return save_processed_text(self.transfer, text_key, format_pages(pages))
+
+    def extract_pages(self, s3_key, start_page, end_page):
+        """OCR a batch with Textract and return its pages, or None if the job failed"""
+        # Skip OCR entirely if these exact pages were processed before
+        cache_key, cached = self._cache_lookup(s3_key, start_page)
+        if cached is not None:
+            return cached
+
+        job_id = self.start_job(s3_key)
+        _, status = next(self._harvest([job_id]))
+        return self._collect_pages(job_id, status, start_page, end_page, cache_key)
+
+    def _cache_lookup(self, s3_key, start_page):
+        """Returns (cache_key, cached pages or None)"""
+        if self.cache is None:
+            return None, None
+        pdf_data = self.transfer.get(s3_key)
+        version = f"{self.ENGINE_VERSION}-geometry" if self.keep_geometry else self.ENGINE_VERSION
+        cache_key = ocr_cache_key(pdf_data, self.ENGINE_NAME, version, start_page)
+        cached = load_cached_pages(self.cache, cache_key)
+        if cached is not None:
+            logger.info(f"OCR cache hit for {s3_key}")
+        return cache_key, cached
+
+    def start_job(self, s3_key):
+        """Start async text detection and return the job id"""
+        request = {
+            'DocumentLocation': {
                 'S3Object': {
                     'Bucket': self.bucket_name,
                     'Name': s3_key
                 }
-            }
-        )
-        
+            },
+            'JobTag': self.book_name[:64]
+        }
+        if self.notification_channel:
+            request['NotificationChannel'] = self.notification_channel
+
+        response = self.textract.start_document_text_detection(**request)
         job_id = response['JobId']
+        self.dispatcher.watch(job_id)
         logger.info(f"Started Textract job {job_id} for {s3_key}")
-        
-        # Poll for completion
-        while True:
-            result = self.textract.get_document_text_detection(JobId=job_id)
-            status = result['JobStatus']
-            
-            if status == 'SUCCEEDED':
-                # Get all blocks
-                all_blocks = result['Blocks']
-                next_token = result.get('NextToken')
-                
-                while next_token:
-                    result = self.textract.get_document_text_detection(
-                        JobId=job_id, NextToken=next_token
-                    )
-                    all_blocks.extend(result['Blocks'])
-                    next_token = result.get('NextToken')
-                
-                # Extract structured text
-                structured_text = self._extract_structured_text(all_blocks, start_page, end_page)
-                
-                # Save processed text
-                batch_filename = s3_key.split('/')[-1].replace('.pdf', '')
-                text_key = f"{self.book_name}/output/processed/{batch_filename}.txt"
-                
-                self.s3.put_object(
-                    Bucket=self.bucket_name,
-                    Key=text_key,
-                    Body=structured_text,
-                    ContentType='text/plain'
-                )
-                
-                logger.info(f"Saved processed text: {text_key}")
-                return text_key
-                
-            elif status == 'FAILED':
-                logger.error(f"Textract job {job_id} failed")
-                return None
-                
+        return job_id
+
+    def _harvest(self, job_ids):
+        """Yield (job_id, status) for each job as it finishes"""
+        outstanding = set(job_ids)
+        while outstanding:
+            finished = self.dispatcher.wait_any(outstanding, self.fallback_poll_interval)
+            # Without news for a while, check in case a completion message was lost
+            if not finished and self.completion_queue:
+                finished = self._poll_statuses(outstanding)
+                self.dispatcher.finished_by_poll(finished)
+
+            for job_id, status in finished.items():
+                outstanding.discard(job_id)
+                yield job_id, status
+
+    def _poll_statuses(self, job_ids):
+        """Ask Textract directly which of job_ids have finished"""
+        finished = {}
+        for job_id in job_ids:
+            status = self.textract.get_document_text_detection(JobId=job_id, MaxResults=1)['JobStatus']
+            if status in FINISHED_STATUSES:
+                finished[job_id] = status
             else:
                 logger.info(f"Job {job_id} status: {status}, waiting...")
-                time.sleep(3)
-    
-    def _extract_structured_text(self, textract_blocks, start_page, end_page):
-        """Extract text with page numbers and figure placeholders"""
-        pages = {}
-        
-        # Group blocks by page
-        for block in textract_blocks:
-            if 'Page' in block:
-                page_num = block['Page'] + start_page - 1
-                if page_num not in pages:
-                    pages[page_num] = {'lines': [], 'figures': []}
-                
-                if block['BlockType'] == 'LINE':
-                    pages[page_num]['lines'].append(block['Text'])
-                elif block['BlockType'] == 'WORD' and 'figure' in block['Text'].lower():
-                    pages[page_num]['figures'].append(f"[FIGURE_PLACEHOLDER_{page_num}]")
-        
-        # Build structured text
-        result = []
-        for page_num in sorted(pages.keys()):
-            result.append(f"\n--- PAGE {page_num} ---\n")
-            result.extend(pages[page_num]['lines'])
-            result.extend(pages[page_num]['figures'])
-        
-        return '\n'.join(result)
\ No newline at end of file
+        return finished
+
+    def _collect_pages(self, job_id, status, start_page, end_page, cache_key):
+        """Fetch a finished job's blocks and extract its pages"""
+        if status == 'FAILED':
+            logger.error(f"Textract job {job_id} failed")
+            return None
+        if status == 'PARTIAL_SUCCESS':
+            logger.warning(f"Textract job {job_id} only partially succeeded")
+
+        # Consume each page of results as it arrives rather than collecting all blocks
+        assembler = _PageAssembler(start_page, self.keep_geometry)
+        next_token = None
+        while True:
+            request = {'JobId': job_id}
+            if next_token:
+                request['NextToken'] = next_token
+            result = self.textract.get_document_text_detection(**request)
+            assembler.add_blocks(result['Blocks'])
+            next_token = result.get('NextToken')
+            if not next_token:
+                break
+
+        pages = [page for page in assembler.pages() if page['page_number'] <= end_page]
+
+        if cache_key and pages:
+            store_cached_pages(self.cache, cache_key, pages)
+
+        return pages
@@ -0,0 +1,39 @@
+#test_layout.py
+from src.layout import analyze_page
+from src.ocr_pages import make_page
+
+
+def page_with_lines(rows):
+    """rows: (text, top, height); lines span the text block"""
+    lines, boxes = [], []
+    for text, top, height in rows:
+        lines.append(text)
+        boxes.extend((0.1, top, 0.8, height))
+    return make_page(1, '\n'.join(lines), lines=lines, boxes=boxes)
+
+
+def body_rows(count, first_top=0.1):
+    return [(f"the king had sent his messengers to the coast, line {i}", first_top + i * 0.035, 0.025)
+            for i in range(count)]
+
+
+def test_numbered_footnotes_in_footer_band_are_footnotes():
+    page = analyze_page(page_with_lines(body_rows(20) + [
+        ("1 See Bowdich, Mission from Cape Coast Castle to Ashantee, p. 72.", 0.915, 0.016),
+        ("2 Ibid. chap. iv.", 0.94, 0.016),
+        ("42", 0.97, 0.016),
+    ]))
+
+    assert page["regions"]["footer"] == []
+    assert page["regions"]["page_number"] == ["42"]
+    assert page["regions"]["footnote"] == [
+        "1 See Bowdich, Mission from Cape Coast Castle to Ashantee, p. 72.",
+        "2 Ibid. chap. iv.",
+    ]
+
+
+def test_roman_looking_last_word_is_not_a_page_number():
+    page = analyze_page(page_with_lines(body_rows(24, first_top=0.1) + [("vivid.", 0.95, 0.025)]))
+
+    assert page["regions"]["page_number"] == []
+    assert "vivid." in page["text"]
@@ -0,0 +1,30 @@
+#test_page_classifier.py
+from src.page_classifier import classify_page, LLM, PROSE
+
+PROSE_TEXT = '\n'.join([
+    "the king had sent his messengers down to the coast with gold dust and",
+    "cloth for the governor, who received them in the hall of the castle and",
+    "heard their message with every mark of attention, though he knew well",
+    "enough that the presents were meant to buy his silence on the matter of",
+    "the northern tribes, whose quarrel with the capital was then at its height",
+    "and threatened to close the paths to every trader for a season or more.",
+    "The embassy set out on the following morning.",
+    "we marched for three days through forest so close that the sun was seen",
+    "only at noon, and the carriers complained bitterly of the heat and of the",
+    "weight of the loads, which the rains had soaked through before we had gone",
+    "a mile beyond the last of the villages that owed allegiance to the fort.",
+])
+
+
+def test_plain_prose_is_built_locally():
+    assert classify_page(PROSE_TEXT) == PROSE
+
+
+def test_page_edge_artefacts_go_to_the_llm():
+    assert classify_page("142\n" + PROSE_TEXT) == LLM
+    assert classify_page(PROSE_TEXT + "\n143") == LLM
+    assert classify_page("Mission to Ashantee.\n" + PROSE_TEXT) == LLM
+
+
+def test_paragraph_end_carried_over_from_the_previous_page_is_prose():
+    assert classify_page("of the river.\n" + PROSE_TEXT) == PROSE
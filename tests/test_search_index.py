@@ -0,0 +1,11 @@
+#test_search_index.py
+from src.search_index import tokenize
+
+
+def test_elided_past_tense_is_expanded():
+    assert tokenize("He arriv'd and shew'd us") == ["he", "arrived", "and", "showed", "us"]
+
+
+def test_pronoun_contractions_are_not_expanded():
+    assert tokenize("he'd she'd they'd") == ["he", "d", "she", "d", "they", "d"]
+    assert "heed" not in tokenize("he'd")
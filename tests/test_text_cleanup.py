@@ -0,0 +1,29 @@
+#test_text_cleanup.py
+import random
+from src.ocr_pages import make_page, format_pages
+from src.text_cleanup import TextCleaner
+
+WORDS = "the king had sent his messengers to the coast with gold and cloth for the governor".split()
+
+
+def body(rng, lines=6):
+    return '\n'.join(' '.join(rng.choice(WORDS) for _ in range(10)) for _ in range(lines))
+
+
+def test_numbered_chapter_headings_at_page_edges_are_kept():
+    rng = random.Random(14)
+    pages = []
+    for n in range(1, 13):
+        head = f"CHAPTER {n // 2 + 1}." if n % 2 else f"{n} MISSION TO ASHANTEE"
+        pages.append(make_page(n, f"{head}\n{body(rng)}\n{n}"))
+
+    out = TextCleaner().clean(format_pages(pages))
+
+    assert out.count('CHAPTER') == 6
+    assert 'MISSION TO ASHANTEE' not in out
+
+
+def test_dehyphenation_does_not_add_a_paragraph_break():
+    out = TextCleaner().clean(format_pages([make_page(1, "it was exam-\nple\nof the thing")]))
+
+    assert "it was example\nof the thing" in out
@@ -3,19 +3,103 @@ import os
 import logging
 from pathlib import Path
 from src.book_digitizer import BookDigitizer  
+from src.cache import LocalDiskCache, S3Cache, SQLiteCache
 import boto3
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def build_ocr_cache(bucket):
+    """OCR cache from OCR_CACHE_DIR or OCR_CACHE_S3_PREFIX, if either is set"""
+    cache_dir = os.getenv('OCR_CACHE_DIR')
+    s3_prefix = os.getenv('OCR_CACHE_S3_PREFIX')
+    if cache_dir:
+        max_mb = os.getenv('OCR_CACHE_MAX_MB')
+        max_age_days = os.getenv('OCR_CACHE_MAX_AGE_DAYS')
+        return LocalDiskCache(
+            cache_dir,
+            max_bytes=int(max_mb) * 1024 * 1024 if max_mb else None,
+            max_age_seconds=float(max_age_days) * 86400 if max_age_days else None
+        )
+    if s3_prefix:
+        return S3Cache(bucket, s3_prefix)
+    return None
+
+def build_llm_cache(bucket):
+    """Bedrock response cache from LLM_CACHE_PATH or LLM_CACHE_S3_PREFIX, if either is set"""
+    cache_path = os.getenv('LLM_CACHE_PATH')
+    s3_prefix = os.getenv('LLM_CACHE_S3_PREFIX')
+    if cache_path:
+        return SQLiteCache(cache_path)
+    if s3_prefix:
+        return S3Cache(bucket, s3_prefix)
+    return None
+
+def build_ocr_engine_options():
+    """Per-engine constructor options from env vars"""
+    options = {}
+    sns_topic_arn = os.getenv('TEXTRACT_SNS_TOPIC_ARN')
+    sqs_queue_url = os.getenv('TEXTRACT_SQS_QUEUE_URL')
+    if sns_topic_arn and sqs_queue_url:
+        from src.textract_processor import SQSCompletionQueue
+        options['textract'] = {
+            'notification_channel': {
+                'SNSTopicArn': sns_topic_arn,
+                'RoleArn': os.environ['TEXTRACT_SNS_ROLE_ARN']
+            },
+            'completion_queue': SQSCompletionQueue(sqs_queue_url)
+        }
+    return options
+
+def configure_bedrock():
+    """Set up the shared Bedrock invoker before any LLMParser uses it"""
+    from src.bedrock_client import get_invoker
+    return get_invoker(
+        'us-east-1',
+        max_concurrency=int(os.getenv('BEDROCK_MAX_CONCURRENCY', 8)),
+        requests_per_second=float(os.getenv('BEDROCK_REQUESTS_PER_SECOND', 1.0))
+    )
+
+def run_stage(digitizer, stage, description, func):
+    """Run a pipeline stage unless the run manifest says it already finished"""
+    if digitizer.manifest.is_stage_complete(stage):
+        logger.info(f"Skipping '{description}': already complete")
+        return
+    logger.info(description)
+    func()
+    digitizer.manifest.complete_stage(stage)
+    logger.info(f"{description} complete")
+
 def main():
     bucket = os.getenv('S3_BUCKET') or os.getenv('BUCKET_NAME')
     pdf_key = os.getenv('S3_KEY')
     batch_size = int(os.getenv('BATCH_SIZE', 20))
+    ocr_workers = int(os.getenv('OCR_WORKERS', 4))
+    llm_workers = int(os.getenv('LLM_WORKERS', 4))
+    chapter_mode = os.getenv('CHAPTER_MODE', 'sequential')
+    resume = os.getenv('RESUME', '1') != '0'
+    ocr_engine = os.getenv('OCR_ENGINE', 'google-vision')
+    ocr_fallback_engine = os.getenv('OCR_FALLBACK_ENGINE') or None
+    ocr_routes = os.getenv('OCR_ENGINE_ROUTES')
+    ocr_min_confidence = float(os.getenv('OCR_MIN_CONFIDENCE', 0.5))
+    ocr_layout = os.getenv('OCR_LAYOUT', '0') == '1'
+    llm_token_budget = int(os.getenv('LLM_TOKEN_BUDGET', 6000))
+    text_cleanup = os.getenv('TEXT_CLEANUP', '1') != '0'
+    llm_skip_trivial = os.getenv('LLM_SKIP_TRIVIAL', '1') != '0'
+    llm_stream = os.getenv('LLM_STREAM', '0') == '1'
+    llm_model_id = os.getenv('LLM_MODEL_ID', 'anthropic.claude-3-sonnet-20240229-v1:0')
+    llm_prompt_caching = os.getenv('LLM_PROMPT_CACHING', '0') == '1'
+    image_chunk_pages = int(os.getenv('IMAGE_CHUNK_PAGES', 20))
+    image_workers = int(os.getenv('IMAGE_WORKERS', 4))
+    image_source = os.getenv('IMAGE_SOURCE', 'mistral')
+    transfer_workers = int(os.getenv('S3_TRANSFER_WORKERS', 16))
+    search_index = os.getenv('SEARCH_INDEX', '1') != '0'
     tmp_dir = os.getenv('TMP_DIR', '/tmp')
 
     if not bucket or not pdf_key:
         raise ValueError("S3_BUCKET (or BUCKET_NAME) and S3_KEY env vars must be set")
+    
+    configure_bedrock()
 
     logger.info(f"Starting digitization task for bucket: {bucket}, key: {pdf_key}")
     
@@ -23,34 +107,77 @@ def main():
     download_path = Path(tmp_dir) / Path(pdf_key).name
     logger.info(f"Downloading PDF to {download_path}")
     s3.download_file(bucket, pdf_key, str(download_path))
+    source_id = s3.head_object(Bucket=bucket, Key=pdf_key)['ETag']
 
     book_name = pdf_key.split('/')[0]
     logger.info(f"Initializing BookDigitizer for book: {book_name}")
-    digitizer = BookDigitizer(source_pdf=download_path, book_name=book_name, gcs_bucket_name="book-digitzation-bucket")
+    digitizer = BookDigitizer(
+        source_pdf=download_path,
+        book_name=book_name,
+        gcs_bucket_name="book-digitzation-bucket",
+        ocr_workers=ocr_workers,
+        llm_workers=llm_workers,
+        chapter_mode=chapter_mode,
+        ocr_cache=build_ocr_cache(bucket),
+        llm_cache=build_llm_cache(bucket),
+        ocr_engine=ocr_engine,
+        ocr_fallback_engine=ocr_fallback_engine,
+        ocr_routes=ocr_routes,
+        ocr_min_confidence=ocr_min_confidence,
+        ocr_engine_options=build_ocr_engine_options(),
+        ocr_layout=ocr_layout,
+        llm_token_budget=llm_token_budget,
+        text_cleanup=text_cleanup,
+        llm_skip_trivial=llm_skip_trivial,
+        llm_stream=llm_stream,
+        llm_model_id=llm_model_id,
+        llm_prompt_caching=llm_prompt_caching,
+        transfer_workers=transfer_workers
+    )
+    
+    run_config = digitizer.run_config(image_source=image_source)
+    if resume:
+        digitizer.resume_run(batch_size, source_id=source_id, config=run_config)
+    else:
+        digitizer.manifest.reset(source_id, run_config)
     
-    logger.info(f"Running batch_and_upload_pdf with batch_size={batch_size}")
-    digitizer.batch_and_upload_pdf(batch_size=batch_size)
-    logger.info("Batch upload complete")
+    run_stage(digitizer, 'split', f"Running batch_and_upload_pdf with batch_size={batch_size}",
+              lambda: digitizer.batch_and_upload_pdf(batch_size=batch_size))
 
-    logger.info("Extracting images from original PDF")
-    digitizer.extract_and_upload_images()
-    logger.info("Image extraction complete")
+    if image_source == 'local':
+        run_stage(digitizer, 'images', "Extracting embedded images from original PDF",
+                  lambda: digitizer.extract_images_locally(chunk_pages=image_chunk_pages,
+                                                           workers=image_workers))
+    else:
+        run_stage(digitizer, 'images', "Extracting images from original PDF",
+                  lambda: digitizer.extract_and_upload_images(chunk_pages=image_chunk_pages,
+                                                             workers=image_workers))
 
-    logger.info("Processing text with Google and LLM")
-    digitizer.process_with_ocr()
+    # Always runs: batches finished by an earlier attempt are loaded, not redone
+    logger.info(f"Processing text with {ocr_engine} and LLM (chapter_mode={chapter_mode}, "
+                f"ocr_workers={ocr_workers}, llm_workers={llm_workers})")
+    missing = digitizer.process_with_ocr()
+    if missing:
+        # Left incomplete so a rerun parses them and rebuilds the later stages
+        logger.warning(f"Batches {missing} could not be parsed; a rerun will retry them")
+    else:
+        digitizer.manifest.complete_stage('ocr')
     logger.info("LLM processing complete")
     
-    logger.info("Linking images to content")
-    digitizer.link_images_to_content()
-    logger.info("Image linking complete")
+    run_stage(digitizer, 'link_images', "Linking images to content",
+              digitizer.link_images_to_content)
+    
+    run_stage(digitizer, 'chapters', "Creating chapter structure",
+              digitizer.create_quarto_chapters)
+    
+    run_stage(digitizer, 'book', "Creating final Quarto book",
+              digitizer.create_quarto_book)
     
-    logger.info("Creating chapter structure")
-    digitizer.create_quarto_chapters()
-    logger.info("Chapter creation complete")
+    if search_index:
+        run_stage(digitizer, 'search_index', "Building full-text search index",
+                  lambda: digitizer.build_search_index(work_dir=tmp_dir))
     
-    logger.info("Creating final Quarto book")
-    digitizer.create_quarto_book()
-    logger.info("Book creation complete")
+    digitizer.save_transfer_report()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file